@@ -6,8 +6,13 @@
 import cv2
 import datetime
 import logging
+import numpy
+import os
 import time
-from threading import Thread
+import Queue
+import runtime
+import worker_pool
+from threading import Condition, Lock
 
 
 class CameraManager:
@@ -17,59 +22,117 @@ class CameraManager:
         self.logger = logging.getLogger("DomoRoom-camera_manager")  # Default logger
         self.cameras = []  # All the cameras in use
         self.motion_detection_status = False  # Is motion detection enabled?
-        self.motion_threshold = 3000  # Minimum distance between images to trigger the motion detection
-        self.motion_sleep = 2  # Interval (in seconds) between two motion detection shots
-        self.motion_refresh_frequency = 4  # How many shots to refresh the first capture
+        self.motion_threshold = 0.01  # Minimum fraction of changed pixels to trigger the motion detection
+        self.motion_sleep = 0.5  # Interval (in seconds) between two motion detection shots
+        self.headless = not os.environ.get("DISPLAY")  # Without a display the preview window is never opened
+        self.preview_status = False  # Is the preview window open?
+        self.preview_fps = 10  # Maximum preview refresh rate, the capture runs at the camera rate
+        self.clip_recording = True  # Save a video clip around every motion event
+        self.clips_path = "../resources/imgs/"  # Folder of the motion clips
+        self.clip_pre_roll = 5  # Seconds recorded before the motion event
+        self.clip_post_roll = 10  # Seconds recorded after the last motion event
+        self.clip_fps = 10  # Clips frame rate, the capture runs at the camera rate
+        self.clip_compress = True  # Keep the buffered frames JPEG compressed, ~20 times less memory
+        self.episodes = MotionEpisodes(self)  # Groups the detections in episodes and sends their alerts
         self.add_cam(0)  # Attach the default camera  TODO find a better way to initialize camera manager
-        self.last_shot = None  # Last captured shot
-        Thread(target=self.acquire_shot, args=[self.cameras[0]]).start()  # TODO manage multi camera option
+        if not self.headless:
+            self.turn_on_preview()
 
-    def add_cam(self, camera):  # Add a camera to the cameras list
-        if isinstance(camera, Camera):
-            self.cameras.append(camera)
-            return True
-        elif isinstance(camera, int):
+    def add_cam(self, camera):  # Add a camera to the cameras list and start capturing from it
+        if isinstance(camera, int):
             try:
-                self.cameras.append(Camera(camera))
-                return True
+                camera = Camera(camera)
             except cv2.error:
                 self.logger.warning("Could not open the camera")
+                return False
+        if isinstance(camera, Camera):
+            self.cameras.append(camera)
+            runtime.spawn("camera", self.acquire_shot, [camera], "capture " + str(camera))
+            if self.clip_recording:
+                camera.recorder = ClipRecorder(camera, self.clips_path, self.clip_pre_roll, self.clip_post_roll,
+                                               self.clip_fps, self.clip_compress)
+            return True
         return False
 
     def remove_cam(self, id):  # Remove a camera from the cameras list
         if isinstance(id, Camera):
             self.cameras.remove(id)
+            id.enabled = False  # Stops its capture and recorder threads
             self.logger.debug("Removed camera: " + str(id))
             return True
         else:
             try:
                 tmp_camera = self.cameras.pop(id)
+                tmp_camera.enabled = False
                 self.logger.debug("Removed camera " + str(tmp_camera) + " at position: " + str(id))
                 return True
             except IndexError:
                 self.logger.warning("Could not remove the camera")
         return False
 
+    def get_frame(self, index=0):  # Return the latest frame of the selected camera, None if not available
+        if 0 <= index < len(self.cameras):
+            return self.cameras[index].slot.get()[0]
+        return None
+
     def shot(self, index=0):  # Shot a photo with the selected camera
         if 0 <= index < len(self.cameras):
-            try:
-                return self.cameras[index].capture_image()  # TODO why not last shot?
-            except:
-                self.logger.warning("An error occurred while taking a photo, cam: " + str(self.cameras[index]))
+            frame = self.get_frame(index)
+            if frame is None:
+                self.logger.warning("No frame captured yet, cam: " + str(self.cameras[index]))
+            return frame
         return None
 
-    def turn_on_motion_detection(self):  # Turn on the motion detection
-        Thread(target=self.motion_detection, args=[0]).start()
+    def turn_on_motion_detection(self):  # Turn on the motion detection on every camera
+        for cam_pos in range(len(self.cameras)):
+            runtime.spawn("camera", self.motion_detection, [cam_pos], "motion detection " + str(cam_pos))
 
     def turn_off_motion_detection(self):  # Turn off the motion detection
         self.motion_detection_status = False
 
-    def acquire_shot(self, cam):  # Keeps emptying the camera buffer
-        while self.enabled:
-            self.last_shot = cam.capture_image()
-            cv2.imshow("Motion scanner", self.last_shot)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+    def stop(self):  # Stop capturing, the capture threads stop their clip recorders
+        self.enabled = False
+        self.turn_off_motion_detection()
+        self.turn_off_preview()
+        self.episodes.stop()
+
+    def acquire_shot(self, cam):  # Keeps emptying the camera buffer, publishing every frame in the camera slot
+        while self.enabled and cam.enabled:
+            frame = cam.capture_image()
+            if frame is None:
+                self.logger.warning("Could not read from " + str(cam))
+                time.sleep(1)
+                continue
+            cam.slot.publish(frame)
+        if cam.recorder is not None:
+            cam.recorder.stop()
+
+    def turn_on_preview(self):  # Open the preview window
+        if self.headless:
+            self.logger.warning("Preview not available in headless mode")
+            return False
+        if not self.preview_status:
+            self.preview_status = True
+            runtime.spawn("camera", self.preview)
+        return True
+
+    def turn_off_preview(self):  # Close the preview window
+        self.preview_status = False
+
+    def preview(self):  # Show the latest frames at preview_fps at most, 'q' closes the window
+        sequences = {}  # Last shown frame of every camera
+        while self.enabled and self.preview_status:
+            start = time.time()
+            for cam in list(self.cameras):
+                frame, sequence, timestamp = cam.slot.get()
+                if frame is not None and sequence != sequences.get(cam.index):
+                    cv2.imshow("Motion scanner " + str(cam.index), frame)
+                    sequences[cam.index] = sequence
+            wait = max(1, int((1.0 / self.preview_fps - (time.time() - start)) * 1000))
+            if cv2.waitKey(wait) & 0xFF == ord('q'):
                 break
+        self.preview_status = False
+        cv2.destroyAllWindows()
 
     def motion_detection(self, cam_pos, script=None):  # Detect motion on a given camera
         self.motion_detection_status = True
@@ -78,30 +141,26 @@ class CameraManager:
             self.logger.warning("Invalid camera pos")
             return
         time.sleep(5)
-        frame1 = None
-        refresh_frequency = 0
+        slot = self.cameras[cam_pos].slot
+        detector = MotionDetector(min_changed_ratio=self.motion_threshold)
+        sequence = 0  # Last processed frame
         self.logger.info("Motion detection enabled")
         while self.motion_detection_status:
-            if frame1 is None or refresh_frequency == 0:
-                frame1 = cv2.cvtColor(self.last_shot, cv2.COLOR_BGR2GRAY)
-                refresh_frequency = self.motion_refresh_frequency
-            frame2 = self.last_shot
-            gray_frame2 = cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)
-            distance = cv2.norm(frame1, gray_frame2, cv2.NORM_L2)  # Manhattan norm
-            # difference = cv2.absdiff(frame1, frame2) difference between the two images
-            if distance > self.motion_threshold:
-                print("Detected Motion at " + str(datetime.datetime.now()) + " distance: " + str(distance))
-                self.parent.telegram_manager.broadcast_message("Detected motion! ")
-                self.add_time(frame2)
-                self.parent.telegram_manager.broadcast_image(frame2)
-                if script is not None:
-                    try:
-                        script()
-                    except:
-                        self.logger.error("Failed to run the motion detection script")
-                logging.info("Detected motion")
-                refresh_frequency -= 1
+            frame2, sequence, timestamp = slot.wait_next(sequence, self.motion_sleep)
+            detector.min_changed_ratio = self.motion_threshold
+            motion, changed_ratio = detector.process(frame2)
+            if motion:
+                self.logger.debug("Detected motion on " + str(self.cameras[cam_pos]) + " changed: " +
+                                  str(changed_ratio))
+                if self.cameras[cam_pos].recorder is not None:
+                    self.cameras[cam_pos].recorder.trigger()
+            if self.episodes.update(cam_pos, motion, changed_ratio, frame2, time.time()) and script is not None:
+                try:
+                    script()
+                except:
+                    self.logger.error("Failed to run the motion detection script")
             time.sleep(self.motion_sleep)
+        self.episodes.close(cam_pos)
         self.logger.info("Motion detection disabled")
 
     @staticmethod
@@ -110,11 +169,335 @@ class CameraManager:
                     (0, img.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 1, 3)
 
 
+class MotionEpisodes:  # Debounces the detections in motion episodes, the alerts are delivered asynchronously
+    def __init__(self, parent, episode_gap=10, alert_interval=60):
+        self.parent = parent  # Camera manager
+        self.logger = logging.getLogger("DomoRoom-motion_episodes")  # Default logger
+        self.episode_gap = episode_gap  # Seconds without motion that end an episode
+        self.alert_interval = alert_interval  # Minimum seconds between two alerts of the same camera
+        self.episodes = {}  # Camera position: open MotionEpisode
+        self.last_alerts = {}  # Camera position: time of the last alert
+        self.suppressed = {}  # Camera position: episodes not reported because of the rate limit
+        self.lock = Lock()  # Protects the episodes
+        self.pool = worker_pool.WorkerPool("motion_alerts", size=1, default_timeout=120,
+                                           subsystem="camera")  # Delivers the alerts
+
+    def update(self, cam_pos, motion, changed_ratio, frame, timestamp):  # Feed a detection, True if it opens an episode
+        with self.lock:
+            episode = self.episodes.get(cam_pos)
+            if episode is not None and timestamp - episode.last > self.episode_gap:
+                self.end(cam_pos, episode)
+                episode = None
+            if not motion:
+                return False
+            if episode is not None:
+                episode.add(frame, changed_ratio, timestamp)
+                return False
+            episode = MotionEpisode(frame, changed_ratio, timestamp)
+            self.episodes[cam_pos] = episode
+            if self.allowed(cam_pos, timestamp):
+                episode.alerted = True
+                self.send(cam_pos, "Detected motion on camera " + str(cam_pos) + self.suppressed_text(cam_pos),
+                          episode.first)
+            return True
+
+    def close(self, cam_pos):  # End the open episode of a camera
+        with self.lock:
+            episode = self.episodes.get(cam_pos)
+            if episode is not None:
+                self.end(cam_pos, episode)
+
+    def end(self, cam_pos, episode):  # Send the episode summary (the lock must be held)
+        del self.episodes[cam_pos]
+        text = "Motion on camera " + str(cam_pos) + " ended, lasted " + str(int(episode.last - episode.start)) + \
+               "s, " + str(episode.detections) + " detections, peak " + str(int(episode.best_ratio * 100)) + "% changed"
+        if episode.alerted:  # The first frame has already been sent
+            self.send(cam_pos, text, episode.best if episode.best is not episode.first else None)
+        elif self.allowed(cam_pos, episode.last):
+            self.send(cam_pos, text + self.suppressed_text(cam_pos), episode.first,
+                      episode.best if episode.best is not episode.first else None)
+        else:
+            self.suppressed[cam_pos] = self.suppressed.get(cam_pos, 0) + 1
+
+    def allowed(self, cam_pos, timestamp):  # Check and update the camera rate limit (the lock must be held)
+        if timestamp - self.last_alerts.get(cam_pos, 0) < self.alert_interval:
+            return False
+        self.last_alerts[cam_pos] = timestamp
+        return True
+
+    def suppressed_text(self, cam_pos):  # Report and reset the episodes skipped by the rate limit
+        count = self.suppressed.pop(cam_pos, 0)
+        return "" if not count else " (" + str(count) + " more episodes since the last alert)"
+
+    def send(self, cam_pos, text, *frames):  # Queue an alert, detection never waits for the delivery
+        self.pool.submit(self.deliver, (text, [f for f in frames if f is not None]), cam_pos,
+                         name="motion alert " + str(cam_pos))
+
+    def deliver(self, text, frames):  # Broadcast an alert, runs on the delivery thread
+        for task in self.parent.parent.telegram_manager.broadcast_message(text):
+            task.wait()  # The text comes before the frames
+        for frame in frames:
+            self.parent.parent.telegram_manager.broadcast_image(frame)
+
+    def stop(self):  # Stop delivering the alerts
+        self.pool.stop()
+
+
+class MotionEpisode:  # Consecutive detections of a camera
+    def __init__(self, frame, changed_ratio, timestamp):
+        self.start = timestamp  # Time of the first detection
+        self.last = timestamp  # Time of the last detection
+        self.detections = 1  # Detections in the episode
+        self.first = MotionEpisode.annotate(frame)  # First detected frame
+        self.best = self.first  # Frame with the most changed pixels
+        self.best_ratio = changed_ratio  # Fraction of changed pixels of the best frame
+        self.alerted = False  # Has the episode start been reported?
+
+    def add(self, frame, changed_ratio, timestamp):  # Add a detection to the episode
+        self.last = timestamp
+        self.detections += 1
+        if changed_ratio > self.best_ratio:
+            self.best = MotionEpisode.annotate(frame)
+            self.best_ratio = changed_ratio
+
+    @staticmethod
+    def annotate(frame):  # Return a timestamped copy of a published frame
+        frame = frame.copy()  # Published frames are read only
+        CameraManager.add_time(frame)
+        return frame
+
+
+class MotionDetector:  # Compares the frames with a running average background on small, blurred copies
+    def __init__(self, width=320, blur_size=11, learning_rate=0.05, pixel_threshold=25, min_changed_ratio=0.01,
+                 lighting_change_ratio=0.6, min_contour_area=None):
+        self.width = width  # Width of the processed frames, the cost doesn't depend on the camera resolution
+        self.blur_size = (blur_size, blur_size)  # Gaussian blur kernel, hides the sensor noise
+        self.learning_rate = learning_rate  # How fast the background follows the scene
+        self.pixel_threshold = pixel_threshold  # Minimum gray level difference of a changed pixel
+        self.min_changed_ratio = min_changed_ratio  # Minimum fraction of changed pixels to report motion
+        self.lighting_change_ratio = lighting_change_ratio  # Larger changes are lights switched on/off, not motion
+        self.min_contour_area = min_contour_area  # If set, motion also needs a changed blob at least this large
+        self.source_shape = None  # Height and width of the frames the buffers were allocated for
+        self.small = None  # Preallocated buffers, created on the first frame
+        self.gray = None
+        self.background = None
+        self.background_gray = None
+        self.delta = None
+        self.mask = None
+
+    def allocate(self, frame):  # Allocate the buffers for the frame aspect ratio
+        self.source_shape = frame.shape[:2]
+        height = max(1, int(round(frame.shape[0] * self.width / float(frame.shape[1]))))
+        self.small = numpy.empty((height, self.width, 3), numpy.uint8)
+        self.gray = numpy.empty((height, self.width), numpy.uint8)
+        self.background = numpy.empty((height, self.width), numpy.float32)
+        self.background_gray = numpy.empty((height, self.width), numpy.uint8)
+        self.delta = numpy.empty((height, self.width), numpy.uint8)
+        self.mask = numpy.empty((height, self.width), numpy.uint8)
+
+    def prepare(self, frame):  # Downscale, convert to gray and blur the frame into the gray buffer
+        cv2.resize(frame, (self.width, self.gray.shape[0]), dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.GaussianBlur(self.gray, self.blur_size, 0, dst=self.gray)
+
+    def reset(self):  # Adopt the last prepared frame as the background
+        self.background[...] = self.gray
+
+    def process(self, frame):  # Return (motion detected, fraction of changed pixels) and update the background
+        if frame is None:
+            return False, 0.0
+        if frame.shape[:2] != self.source_shape:
+            self.allocate(frame)
+            self.prepare(frame)
+            self.reset()
+            return False, 0.0
+        self.prepare(frame)
+        cv2.convertScaleAbs(self.background, dst=self.background_gray)
+        cv2.absdiff(self.gray, self.background_gray, dst=self.delta)
+        cv2.threshold(self.delta, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self.mask)
+        changed_ratio = cv2.countNonZero(self.mask) / float(self.mask.size)
+        if changed_ratio >= self.lighting_change_ratio:  # Global change: adopt the frame as the new background
+            self.reset()
+            return False, changed_ratio
+        cv2.accumulateWeighted(self.gray, self.background, self.learning_rate)
+        motion = changed_ratio >= self.min_changed_ratio
+        if motion and self.min_contour_area is not None:
+            contours = cv2.findContours(self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+            motion = any(cv2.contourArea(c) >= self.min_contour_area for c in contours)
+        return motion, changed_ratio
+
+
+class FrameSlot:  # Latest frame of a camera, swapped by reference: readers never copy it nor block the capture
+    def __init__(self):
+        self.latest = (None, 0, None)  # Frame, sequence number, capture time
+        self.condition = Condition()  # Wakes up the readers waiting for a new frame
+
+    def publish(self, frame):  # Replace the latest frame, the frame must not be modified afterwards
+        frame.flags.writeable = False
+        with self.condition:
+            self.latest = (frame, self.latest[1] + 1, time.time())
+            self.condition.notify_all()
+
+    def get(self):  # Return the latest (frame, sequence number, capture time)
+        return self.latest
+
+    def wait_next(self, sequence, timeout=None):  # Wait for a frame newer than sequence, return the latest one
+        with self.condition:
+            if self.latest[1] <= sequence:
+                self.condition.wait(timeout)
+            return self.latest
+
+
+class FrameRing:  # Fixed size buffer of the latest frames, the oldest frames are overwritten when full
+    def __init__(self, size, compress=True, quality=80):
+        self.size = size  # Maximum frames
+        self.compress = compress  # Store the frames as JPEG bytes instead of raw pixels
+        self.quality = quality  # JPEG quality of the compressed frames
+        self.frames = None if not compress else [None] * size  # Raw frames are preallocated on the first push
+        self.times = numpy.zeros(size)  # Capture times
+        self.start = 0  # Position of the oldest frame
+        self.count = 0  # Buffered frames
+
+    def push(self, frame, timestamp):  # Add a frame, return the stored item
+        if self.compress:
+            item = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1]
+        else:
+            if self.frames is None or self.frames.shape[1:] != frame.shape:  # New resolution: drop the old frames
+                self.frames = numpy.empty((self.size,) + frame.shape, frame.dtype)
+                self.count = 0
+            item = frame
+        pos = (self.start + self.count) % self.size
+        if self.compress:
+            self.frames[pos] = item
+        else:
+            self.frames[pos] = frame
+        self.times[pos] = timestamp
+        if self.count == self.size:
+            self.start = (self.start + 1) % self.size
+        else:
+            self.count += 1
+        return item
+
+    def snapshot(self, since=0):  # Return the items captured after since, oldest first
+        items = []
+        for i in range(self.count):
+            pos = (self.start + i) % self.size
+            if self.times[pos] >= since:
+                items.append(self.frames[pos] if self.compress else self.frames[pos].copy())
+        return items
+
+    def decode(self, item):  # Return the frame of a stored item
+        if self.compress:
+            return cv2.imdecode(item, cv2.IMREAD_COLOR)
+        return item
+
+
+class ClipRecorder:  # Buffers the recent frames of a camera and saves a clip around every trigger
+    def __init__(self, cam, path, pre_roll=5, post_roll=10, fps=10, compress=True, queue_size=600):
+        self.logger = logging.getLogger("DomoRoom-clip_recorder")  # Default logger
+        self.cam = cam  # Recorded camera
+        self.path = path  # Clips folder
+        self.pre_roll = pre_roll  # Seconds saved before the trigger
+        self.post_roll = post_roll  # Seconds saved after the last trigger
+        self.fps = fps  # Buffered frames per second
+        self.ring = FrameRing(int(pre_roll * fps) + 1, compress)  # Pre-roll frames, only used by the buffer thread
+        self.queue = Queue.Queue(queue_size)  # Clip items waiting for the writer
+        self.lock = Lock()  # Protects the trigger flag
+        self.triggered = False  # Has a trigger been received since the last buffered frame?
+        self.recording_until = None  # End of the clip being recorded, None if not recording
+        self.dropped = 0  # Clip frames dropped because the writer is behind
+        self.enabled = True  # Recorder status
+        runtime.spawn("camera", self.behaviour, name="clip buffer " + str(cam.index))
+        runtime.spawn("camera", self.writer, name="clip writer " + str(cam.index))
+
+    def trigger(self):  # Start a clip, or extend the one being recorded
+        with self.lock:
+            self.triggered = True
+
+    def stop(self):  # Stop buffering, the clip being recorded is closed
+        self.enabled = False
+
+    def enqueue(self, item):  # Hand an item to the writer, only frames are dropped when it is behind
+        if item[0] != "frame":
+            self.queue.put(item)  # A lost marker would merge or truncate the clips, wait for a free slot
+            return
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+
+    def behaviour(self):  # Buffer the camera frames at fps, forwarding them to the writer while recording
+        sequence = 0  # Last seen frame
+        last = 0  # Capture time of the last buffered frame
+        while self.enabled and self.cam.enabled:
+            frame, sequence, timestamp = self.cam.slot.wait_next(sequence, 1)
+            if frame is None or timestamp - last < 1.0 / self.fps:
+                continue
+            last = timestamp
+            with self.lock:
+                triggered, self.triggered = self.triggered, False
+            if triggered:
+                if self.recording_until is None:
+                    name = "clip_" + str(self.cam.index) + "_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                    self.enqueue(("start", os.path.join(self.path, name + ".avi")))
+                    for item in self.ring.snapshot(timestamp - self.pre_roll):
+                        self.enqueue(("frame", item))
+                self.recording_until = timestamp + self.post_roll
+            item = self.ring.push(frame, timestamp)
+            if self.recording_until is not None:
+                self.enqueue(("frame", item))
+                if timestamp >= self.recording_until:
+                    self.enqueue(("end", None))
+                    self.recording_until = None
+        if self.recording_until is not None:
+            self.enqueue(("end", None))
+        self.queue.put(None)
+
+    def writer(self):  # Encode the clips, never blocks the capture or the motion detection
+        video = None
+        path = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, data = item
+            if kind == "start":
+                if video is not None:  # The previous clip was never closed
+                    video.release()
+                    self.logger.warning("Saved unterminated clip " + path)
+                path = data
+                video = None
+            elif kind == "frame" and path is not None:
+                frame = self.ring.decode(data)
+                if video is None:
+                    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), self.fps,
+                                            (frame.shape[1], frame.shape[0]))
+                video.write(frame)
+            elif kind == "end" and video is not None:
+                video.release()
+                self.logger.info("Saved clip " + path)
+                if self.dropped:
+                    self.logger.warning("Clip writer behind, dropped " + str(self.dropped) + " frames")
+                    self.dropped = 0
+                video = None
+                path = None
+        if video is not None:
+            video.release()
+
+
 class Camera:
+    recorder = None  # Motion clips recorder
+
     def __init__(self, index=0):
+        self.index = index  # Device index
         self.cam = cv2.VideoCapture(index)  # Camera VideoCapture object
         if not self.cam.isOpened():
             raise cv2.error
+        self.slot = FrameSlot()  # Latest captured frame
+        self.enabled = True  # Capture thread status
+
+    def __str__(self):
+        return "Camera " + str(self.index)
 
     def capture_image(self):  # Shot a photo  TODO addtime parameter
         ret, frame = self.cam.read()
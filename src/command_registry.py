@@ -0,0 +1,150 @@
+#
+#   Author: Alessandro Taufer
+#   Email: alexander141220@gmail.com
+#   Url: https://github.com/AlessandroTaufer
+#
+import logging
+import time
+import database_manager
+from collections import OrderedDict
+from threading import RLock
+
+
+class Argument:  # Positional argument of a command
+    def __init__(self, name, prompt, optional=False, rest=False, default=None):
+        self.name = name  # Name shown in the usage
+        self.prompt = prompt  # Question asked when the argument is missing
+        self.optional = optional  # Can the argument be omitted?
+        self.rest = rest  # Does the argument take all the remaining words?
+        self.default = default  # Value of an omitted optional argument
+
+
+class Command:  # Handler of a keyword, with the arguments it expects
+    def __init__(self, key, handler, arguments=(), name=None, description="", aliases=()):
+        self.key = key  # Keywords file key
+        self.handler = handler  # Called with the source and the argument values, returns the reply
+        self.arguments = list(arguments)  # Argument schema, in order
+        self.defaults = (name or key, description, list(aliases))  # Used if the keywords file doesn't list the key
+        self.name = self.defaults[0]  # Main keyword
+        self.description = description  # Help text
+        self.aliases = list(aliases)  # Other keywords
+
+    def parse(self, words):  # Return the argument values taken from the words, None for the missing ones
+        values = []
+        for argument in self.arguments:
+            if argument.rest:
+                values.append(" ".join(words) if words else None)
+                words = []
+            else:
+                values.append(words.pop(0) if words else None)
+        return values
+
+    def missing(self, values):  # Return the positions of the missing required arguments
+        return [i for i, argument in enumerate(self.arguments) if values[i] is None and not argument.optional]
+
+    def run(self, source, values):  # Call the handler, the omitted optional arguments get their default
+        values = [argument.default if value is None else value for argument, value in zip(self.arguments, values)]
+        return self.handler(source, *values)
+
+    def usage(self):  # Return the command syntax
+        return " ".join([self.name] + [("[" if a.optional else "<") + a.name + ("]" if a.optional else ">")
+                                       for a in self.arguments])
+
+
+class CommandRegistry:  # Maps the keywords and their aliases to the commands, rebuilt when keywords.txt changes
+    def __init__(self, database_manager, check_interval=2):
+        self.database_manager = database_manager  # Keywords file reader
+        self.logger = logging.getLogger("DomoRoom-commands")  # Default logger
+        self.check_interval = check_interval  # Minimum seconds between two checks of the keywords file
+        self.commands = OrderedDict()  # Key: Command, in registration order
+        self.keywords = OrderedDict()  # Key: {"name", "description"} as read from the keywords file
+        self.table = {}  # Keyword or alias: Command, replaced as a whole on every change
+        self.signature = None  # Keywords file signature when loaded
+        self.checked = 0  # Time of the last keywords file check
+        self.lock = RLock()  # Serializes the changes
+        self.reload()
+
+    def register(self, key, handler, arguments=(), name=None, description="", aliases=()):  # Add or replace a command
+        with self.lock:
+            command = Command(key, handler, arguments, name, description, aliases)
+            self.commands[key] = command
+            self.apply(command)
+            self.build()
+            return command
+
+    def unregister(self, key):  # Remove a command, return true if it was registered
+        with self.lock:
+            if self.commands.pop(key, None) is None:
+                return False
+            self.build()
+            return True
+
+    def lookup(self, keyword):  # Return the command of a keyword or alias, None if unknown
+        self.refresh()
+        return self.table.get(keyword)
+
+    def refresh(self):  # Reload the keywords if the file has changed
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            signature = database_manager.DatabaseManager.file_signature(
+                database_manager.DatabaseManager.generate_filename("keywords"))
+        except OSError:
+            return  # Keep the current keywords
+        if signature != self.signature:
+            self.logger.info("Keywords file changed, reloading")
+            self.reload()
+
+    def reload(self):  # Read the keywords file and rebuild the table
+        with self.lock:
+            try:
+                self.signature = database_manager.DatabaseManager.file_signature(
+                    database_manager.DatabaseManager.generate_filename("keywords"))
+                self.keywords = self.database_manager.load_keywords()
+            except (IOError, OSError):
+                self.logger.error("Could not read the keywords file")
+            for command in self.commands.values():
+                self.apply(command)
+            self.build()
+
+    def apply(self, command):  # Set the keywords of a command from the keywords file
+        entry = self.keywords.get(command.key)
+        if entry is None:
+            command.name, command.description, command.aliases = command.defaults[0], command.defaults[1], \
+                list(command.defaults[2])
+            return
+        names = [n.strip() for n in entry.get("name").split("|") if n.strip()]  # "name|alias|alias"
+        command.name = names[0] if names else command.defaults[0]
+        command.aliases = names[1:]
+        command.description = entry.get("description")
+
+    def build(self):  # Rebuild the keyword table (the lock must be held)
+        table = {}
+        for command in self.commands.values():
+            for keyword in [command.name] + command.aliases:
+                if keyword in table and table[keyword] is not command:
+                    self.logger.warning("Keyword '" + keyword + "' of " + command.key + " already used by " +
+                                        table[keyword].key)
+                    continue
+                table[keyword] = command
+        self.table = table
+
+    def help_text(self):  # Return a string containing all the commands
+        self.refresh()
+        lines = []
+        for command in self.commands.values():
+            aliases = " (" + ", ".join(command.aliases) + ")" if command.aliases else ""
+            lines.append(command.name + aliases + " - " + command.description)
+        return "\n".join(lines)
+
+
+class Session:  # Command waiting for the arguments its source is being asked for
+    def __init__(self, command, values):
+        self.command = command  # Command to run
+        self.values = values  # Argument values, None for the ones still missing
+        self.updated = time.time()  # Time of the last answer
+
+    def expired(self, ttl):  # Return true if the source stopped answering
+        return time.time() - self.updated > ttl
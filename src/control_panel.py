@@ -5,12 +5,18 @@
 #
 import logging
 import getpass
+import command_registry
 import database_manager
 import sys
 import select
+import time
 import remote_devices
+import telegram_manager
+import runtime
+import worker_pool
+from command_registry import Argument, Session
 from routines import RoutinesManager
-from threading import Thread
+from threading import Lock
 
 
 class ControlPanel:
@@ -18,8 +24,14 @@ class ControlPanel:
         self.parent = parent  # Class parent
         self.logger = logging.getLogger("DomoRoom-telegram_manager")  # Default logger
         self.enabled = True  # Control panel status
-        self.keywords = self.parent.database_manager.load_keywords()  # List of all the commands keywords
-        Thread(target=self.main_menu, args=()).start()
+        self.commands = command_registry.CommandRegistry(self.parent.database_manager)  # Keyword: command handler
+        self.register_commands()
+        self.bus = worker_pool.WorkerPool("commands", size=4, default_timeout=300,
+                                          subsystem="control_panel")  # Commands of every source
+        self.sessions = {}  # Source: Session of the command waiting for its arguments
+        self.sessions_lock = Lock()  # Protects the sessions
+        self.session_ttl = 300  # Seconds a command waits for the next answer
+        runtime.spawn("control_panel", self.main_menu)
         self.logger.info("Enabled control panel")
 
     @staticmethod
@@ -36,7 +48,13 @@ class ControlPanel:
                 print("Keys are not matching")
         print("Insert the telegram bot api token")
         token = getpass.getpass("Token: ")  # TODO check if the token is working
-        database_manager.DatabaseManager(key).write("telegram", token)
+        database = database_manager.DatabaseManager(key)
+        database.write_line("telegram", token, 0)
+        print("Insert the public webhook url (https, port " + str(telegram_manager.TelegramManager.webhook_port) +
+              "), leave empty to poll for updates")
+        webhook_url = raw_input("Url: ").strip()
+        if webhook_url:
+            database.write_line("telegram", webhook_url, 2)
 
     @staticmethod
     def console_input(timeout=20):  # Get an input from the console
@@ -47,59 +65,79 @@ class ControlPanel:
         else:
             return None
 
-    def main_menu(self):  # User interface
-        choice = ""
+    def main_menu(self):  # Read the console lines and post them on the command bus, never waits for a command
+        print("\n\n\t\t\t\tCONTROL PANEL\n")
+        print(self.get_help())
         while self.enabled:
-            if choice is not None:
-                if choice != "":
-                    self.digest_command(choice)
-                print("\n\n\t\t\t\tCONTROL PANEL\n")
-                print(self.get_help())
-            choice = self.console_input(5)
+            line = self.console_input(1)  # The timeout only lets the loop see the shut down
+            if line is not None and (line != "" or 0 in self.sessions):
+                self.post(line, 0)
 
-    def digest_command(self, command, source=0):  # Execute the given command
+    def post(self, command, source=0):  # Queue a command, the commands of a source run in order
+        self.bus.submit(self.digest_command, (command, source), source, name="command from " + str(source))
+
+    def register_commands(self):  # Register the kernel commands, other modules can register their own
+        register = self.commands.register
+        register("help", lambda source: "HELP:\n" + self.get_help())
+        register("add_chat", self.add_allowed_chat, [Argument("chat", "Insert the chat id: ")])
+        register("remove_chat", self.remove_allowed_chat, [Argument("chat", "Insert the chat position/id to remove: ")])
+        register("list_chats", lambda source: self.parent.telegram_manager.chats_to_string())
+        register("ban_chat", self.ban_chat, [Argument("chat", "Insert the chat id to ban: ")])
+        register("unban_chat", self.unban_chat, [Argument("chat", "Insert the chat id to unban: ")])
+        register("telegram_reminder", self.set_telegram_reminder,
+                 [Argument("name", "Insert the routine name"), Argument("date", "Insert the date: (format dd/mm/yy)"),
+                  Argument("time", "Insert the time: (format hh:mm:ss)"),
+                  Argument("chat", "Insert the address chat:  (return to broadcast)"),
+                  Argument("message", "Insert the message: ", rest=True)])
+        register("list_routines", lambda source: str(self.parent.routines.routines_to_string()))
+        register("capture_image", self.capture_image, [Argument("chat", "Insert the chat id: ", optional=True)])
+        register("security_system", self.security_system, [Argument("status", "Turn on/OFF: ")])
+        register("add_device", self.add_esp_device, [Argument("name", "Insert the device name: "),
+                                                     Argument("ip", "Insert the device ip (format x.x.x.x)")])
+        register("list_devices", lambda source: self.parent.remote_devices.devices_to_string())
+        register("remove_device", self.remove_esp_device, [Argument("device", "Insert the device id/name to remove: ")])
+        register("power_off", self.power_off)
+        register("status", lambda source: self.parent.runtime.report())
+
+    def digest_command(self, command, source=0):  # Execute the given command, or the answer to a prompt
         self.logger.debug("Received command: " + str(command))
-        command = command.lower().split(" ")
-        if len(command) > 0:
-            keyword = command.pop(0)
-        else:
+        with self.sessions_lock:
+            session = self.sessions.pop(source, None)
+        if session is not None and not session.expired(self.session_ttl):
+            if command.strip().lower() == "cancel":
+                self.reply_to(source, "Command cancelled")
+                return
+            session.values[session.command.missing(session.values)[0]] = command.strip().lower()
+            self.continue_command(source, session)
+            return
+        words = command.lower().split()
+        if not words:
             self.reply_to(source, "Empty command")
             return
+        keyword = words.pop(0)
         # TODO add ping command
         if keyword == "addme" and source not in self.parent.telegram_manager.allowed_chats:  # TODO debug addme
             warning_txt = "Chat '" + str(source) + "' requested to be enabled to use the bot"
             self.broadcast_message(warning_txt)
             self.reply_to(source, "Your request has been submitted")
-        elif keyword == self.keywords.get("help").get("name"):
-            help = "HELP:\n" + self.get_help()
-            self.reply_to(source, help)
-        elif keyword == self.keywords.get("add_chat").get("name"):
-            self.reply_to(source, self.add_allowed_chat(command))
-        elif keyword == self.keywords.get("remove_chat").get("name"):
-            self.reply_to(source, self.remove_allowed_chat(command))
-        elif keyword == self.keywords.get("list_chats").get("name"):
-            self.reply_to(source, str(self.parent.telegram_manager.allowed_chats))
-        elif keyword == self.keywords.get("telegram_reminder").get("name"):
-            self.reply_to(source, self.set_telegram_reminder(command))
-        elif keyword == self.keywords.get("list_routines").get("name"):
-            self.reply_to(source, str(self.parent.routines.routines_to_string()))
-        elif keyword == self.keywords.get("capture_image").get("name"):
-            self.reply_to(source, self.capture_image(command))
-        elif keyword == self.keywords.get("security_system").get("name"):
-            self.reply_to(source, self.security_system(command))
-        elif keyword == self.keywords.get("add_device").get("name"):
-            self.add_esp_device(command)
-            self.reply_to(source, "Device plugged to the kernel")  # TODO check if add_esp_device worked
-        elif keyword == self.keywords.get("list_devices").get("name"):
-            self.reply_to(source, "Device list: " + str(self.parent.remote_devices.devices))
-        elif keyword == self.keywords.get("remove_device").get("name"):
-            self.remove_esp_device(command)
-            self.reply_to(source, "Device plugged to the kernel")  # TODO check if remove_esp_device worked
-        elif keyword == self.keywords.get("power_off").get("name"):
-            self.parent.telegram_manager.broadcast_message("Bot is now offline")
-            self.shut_down()
-        else:
+            return
+        handler = self.commands.lookup(keyword)
+        if handler is None:
             self.reply_to(source, "Invalid input")
+            return
+        self.continue_command(source, Session(handler, handler.parse(words)))
+
+    def continue_command(self, source, session):  # Ask the next missing argument or run the command
+        missing = session.command.missing(session.values)
+        if missing:
+            session.updated = time.time()
+            with self.sessions_lock:
+                self.sessions[source] = session  # The next message of the source is the answer
+            self.reply_to(source, session.command.arguments[missing[0]].prompt.rstrip() + " ('cancel' to abort)")
+            return
+        reply = session.command.run(source, session.values)
+        if reply is not None:
+            self.reply_to(source, reply)
 
     def broadcast_message(self, text):  # Broadcast a message on console, telegram chats and logger
         self.parent.telegram_manager.broadcast_message(text)
@@ -112,13 +150,8 @@ class ControlPanel:
         else:
             print(message)
 
-    def add_allowed_chat(self, command):  # Add a chat to the telegram allowed chats list
-        if len(command) > 0:
-            chat = command.pop(0)
-        else:
-            print("Insert the chat id: ")
-            chat = self.console_input()
-        if chat is not None and len(chat) >= 7:
+    def add_allowed_chat(self, source, chat):  # Add a chat to the telegram allowed chats list
+        if len(chat) >= 7:
             try:
                 chat = int(chat)
                 self.parent.telegram_manager.add_allowed_chat(chat)
@@ -130,37 +163,30 @@ class ControlPanel:
             self.logger.warning("Invalid chat id: different digits number")
             return "Invalid input: there are not enough digits"
 
-    def remove_allowed_chat(self, command):  # Remove a chat from the telegram allowed chats list
-        if len(command) > 0:
-            chat_pos = command.pop(0)
-        else:
-            print("Insert the chat position/id to remove: ")
-            chat_pos = self.console_input()
+    def remove_allowed_chat(self, source, chat_pos):  # Remove a chat from the telegram allowed chats list
         if self.parent.telegram_manager.remove_allowed_chat(chat_pos):
             return "Successfully removed from allowed chats"
         else:
             return "Invalid value"
 
-    def set_telegram_reminder(self, command):  # Set a telegram reminder
-        if len(command) >= 4:
-            name = command.pop(0)
-            date = command.pop(0)
-            time = command.pop(0)
-            chat = command.pop(0)
-            message = " ".join(command)
-        else:
-            print("Insert the routine name")
-            name = self.console_input()
-            print("Insert the date: (format dd/mm/yy)")
-            date = self.console_input()
-            print("Insert the time: (format hh:mm:ss)")
-            time = self.console_input()
-            print ("Insert the message: ")
-            message = self.console_input()
-            print("Insert the address chat:  (return to broadcast)")
-            chat = self.console_input()
-            if chat == "":
-                chat = -1
+    def ban_chat(self, source, chat):  # Drop every message of a telegram chat
+        try:
+            self.parent.telegram_manager.ban_chat(chat)
+            return "Chat banned"
+        except (ValueError, TypeError):
+            return "Invalid value"
+
+    def unban_chat(self, source, chat):  # Accept again the messages of a banned telegram chat
+        try:
+            if self.parent.telegram_manager.unban_chat(chat):
+                return "Chat unbanned"
+            return "The chat is not banned"
+        except (ValueError, TypeError):
+            return "Invalid value"
+
+    def set_telegram_reminder(self, source, name, date, time, chat, message):  # Set a telegram reminder
+        if chat == "":
+            chat = -1
         try:
             chat = int(chat)
             date_time = self.datetime_format(date, time)
@@ -186,24 +212,21 @@ class ControlPanel:
         param = date + time
         return RoutinesManager.convert_to_datetime(*param)
 
-    def capture_image(self, command):  # Capture an image an send it to the corresponding chat
+    def capture_image(self, source, chat_pos=None):  # Capture an image an send it to the corresponding chat
         # TODO save a local copy in imgs folder
-        if len(command) > 0:
-            chat_pos = command.pop(0)
-        else:
-            self.parent.telegram_manager.broadcast_image(self.parent.camera_manager.last_shot)
+        image = self.parent.camera_manager.shot()
+        if image is None:
+            return "Could not capture the picture"
+        if chat_pos is None:
+            if not self.parent.telegram_manager.broadcast_image(image):
+                return "Could not send the picture"
             return "Successfully broadcasted picture"
-        if self.parent.telegram_manager.send_image(chat_pos, self.parent.camera_manager.last_shot):
+        if self.parent.telegram_manager.send_image(chat_pos, image):
             return "Successfully sent picture"
         else:
             return "Invalid value"
 
-    def security_system(self, command):  # Enable / Disable the security system
-        if len(command) > 0:
-            status = command.pop(0)
-        else:
-            print("Turn on/OFF: ")
-            status = self.console_input()
+    def security_system(self, source, status):  # Enable / Disable the security system
         status = status.lower() == "on"
         if status:
             self.parent.camera_manager.turn_on_motion_detection()
@@ -217,41 +240,33 @@ class ControlPanel:
         self.logger.info("Backup completed")
 
     def get_help(self):  # Returns a string containing all the commands
-        return "\n".join([e.get("name") + " - " + e.get("description") for e in self.keywords.values()])
+        return self.commands.help_text()
 
-    def add_esp_device(self, command):  # Add a remote device
-        if len(command) > 1:
-            name = command.pop(0)
-            ip = command.pop(0)
-        else:
-            print("Insert the device name: ")
-            name = self.console_input()
-            print("Insert the device ip (format x.x.x.x)")
-            ip = self.console_input()
+    def add_esp_device(self, source, name, ip):  # Add a remote device
         device = remote_devices.EspEasyDevice(name, ip)
-        self.parent.remote_devices.add_device(device)
-
-    def remove_esp_device(self, command):  # Remove a remote device
-        if len(command) > 0:
-            pos = command.pop(0)
+        if self.parent.remote_devices.add_device(device):
+            return "Device plugged to the kernel"
         else:
-            print("Insert the device position/id to remove: ")
-            pos = self.console_input()
+            return "Invalid value"
+
+    def remove_esp_device(self, source, pos):  # Remove a remote device
         if self.parent.remote_devices.del_device(pos):
             return "Successfully removed the device"
         else:
             return "Invalid value"
 
+    def power_off(self, source):  # Say goodbye and shut down
+        self.parent.telegram_manager.broadcast_message("Bot is now offline")
+        self.shut_down()
+
+    def stop(self):  # Stop reading the console and run the queued commands
+        self.enabled = False
+        self.bus.stop(5)
+
     def shut_down(self):  # Shut down the whole program
         self.backup()
-        self.enabled = False
-        self.parent.telegram_manager.enabled = False
-        self.parent.routines.enabled = False
-        self.parent.camera_manager.enabled = False
-        self.parent.camera_manager.turn_off_motion_detection()
-        self.parent.remote_devices.__del__()
         self.logger.info("Exiting program")
-        self.parent.__del__()
+        self.parent.shut_down()
 
 
 if __name__ == "__main__":
@@ -3,70 +3,162 @@
 #   Email: alexander141220@gmail.com
 #   Url: https://github.com/AlessandroTaufer
 #
+import base64
+import json
 import logging
+import os
 import os.path
 import pickle
+import struct
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
 from collections import OrderedDict
+from threading import Lock
 
 
 class DatabaseManager:
     file_names = {"telegram": "telegram.dr", "log": "log.dr", "keywords": "keywords.txt",
-                  "devices": "devices.dr"}  # Database file name
+                  "devices": "devices.dr", "routines": "routines.dr", "groups": "groups.dr"}  # Database file name
     file_path = "../resources/files/"  # Files path
 
+    header = "DR01"  # Marks the files encrypted with a random initialization vector and PKCS7 padding
+    legacy_initialization_vector = 'This is an IV456'  # Fixed vector of the files written by older versions
+    chunk_size = 64 * 1024  # Bytes encrypted/decrypted at a time by the streaming reader and writer
+
     def __init__(self, key):
         self.logger = logging.getLogger("DomoRoom-database_manager")  # Default logger
         self.key = SHA256.new(key).hexdigest()[:32]  # Encryption key
-        self.filler_character = '~'  # Added at the end of the string
+        self.filler_character = '~'  # Added at the end of the string by older versions
+        self.record_stores = {}  # Line indexed stores of the files accessed by line
+        self.object_stores = {}  # Keyed object stores
+        self.cache = ContentCache()  # Decrypted contents of the last read files
         self.logger.info("Successful initialized database manager")
 
-    def init_encryptor(self, key):  # Initialize the encryptor
-        self.logger.debug("Initializing encryptor")
-        initialization_vector = 'This is an IV456'  # TODO Create it randomly
-        encryptor = AES.new(key, AES.MODE_CBC, initialization_vector)  # File encryptor
-        return encryptor
-
-    def encrypt(self, text):  # Encode a string
-        # Convert input text in a multiple of 16 in length
-        next_hex = 0
-        n = len(text)
-        while next_hex < n:
-            next_hex += 16
-        for i in range(0, next_hex - n):
-            text += self.filler_character
-
-        #  Encrypt the text
-        encryptor = self.init_encryptor(self.key)
-        return encryptor.encrypt(text)
-
-    def decrypt(self, encoded):  # Decrypt a string  
-        encryptor = self.init_encryptor(self.key)
-        txt = encryptor.decrypt(encoded)
-        counter = len(encoded)-1
-        while txt[counter] == self.filler_character:
-            counter -= 1
-        return txt[:counter+1]
+    def init_encryptor(self, key, initialization_vector=None):  # Initialize the encryptor
+        if initialization_vector is None:
+            initialization_vector = DatabaseManager.legacy_initialization_vector
+        return AES.new(key, AES.MODE_CBC, initialization_vector)  # File encryptor
 
-    def write(self, file_name, data, encrypted=True, mode="w"):  # Write data in a file
+    def encrypt(self, text):  # Encode a string with a random initialization vector
+        initialization_vector = os.urandom(AES.block_size)
+        encryptor = self.init_encryptor(self.key, initialization_vector)
+        return DatabaseManager.header + initialization_vector + encryptor.encrypt(DatabaseManager.pad(text))
+
+    def decrypt(self, encoded):  # Decrypt a string
+        if not encoded.startswith(DatabaseManager.header):  # Written by an older version
+            return self.init_encryptor(self.key).decrypt(encoded).rstrip(self.filler_character)
+        start = len(DatabaseManager.header)
+        initialization_vector = encoded[start:start + AES.block_size]
+        encryptor = self.init_encryptor(self.key, initialization_vector)
+        return DatabaseManager.unpad(encryptor.decrypt(encoded[start + AES.block_size:]))
+
+    @staticmethod
+    def pad(text):  # PKCS7 padding, makes the text length a multiple of the block size
+        length = AES.block_size - len(text) % AES.block_size
+        return text + chr(length) * length
+
+    @staticmethod
+    def unpad(text):  # Remove the PKCS7 padding
+        if len(text) == 0:
+            raise ValueError("Invalid padding")
+        length = ord(text[-1])
+        if not 0 < length <= AES.block_size or text[-length:] != text[-1] * length:
+            raise ValueError("Invalid padding: wrong key or corrupted data")
+        return text[:-length]
+
+    def open_encrypted(self, file_name, mode="r"):  # Return a file-like object that encrypts/decrypts on the fly
         file_name = DatabaseManager.generate_filename(file_name)
+        if mode == "r":
+            return EncryptedReader(open(file_name, "rb"), self)
+        elif mode == "w":
+            return EncryptedWriter(open(file_name, "wb"), self)
+        raise ValueError("Invalid encrypted file mode: " + mode)
+
+    def write(self, file_name, data, encrypted=True, mode="w"):  # Write data in a file
         if encrypted:
-            data = self.encrypt(data)
+            if mode.startswith("a") and DatabaseManager.file_exist(file_name):
+                data = self.read(file_name) + data  # An encrypted stream can't be extended in place
+            with self.open_encrypted(file_name, "w") as f:
+                f.write(data)
+        else:
+            with open(DatabaseManager.generate_filename(file_name), mode) as f:
+                f.write(data)
+        self.cache.invalidate(DatabaseManager.generate_filename(file_name))
 
-        with open(file_name, mode) as f:
-            f.write(data)
+    def read(self, file_name, decrypt=True):  # Get data from a file, from the cache if it didn't change
+        path = DatabaseManager.generate_filename(file_name)
+        data = self.cache.get(path, decrypt)
+        if data is not None:
+            return data
+        signature = DatabaseManager.file_signature(path)  # Taken before reading, a concurrent change is a miss later
+        if decrypt and RecordStore.is_record_file(path):
+            data = "\n".join(self.record_store(file_name).read_all())
+        elif decrypt:
+            with self.open_encrypted(file_name) as f:
+                data = f.read()
+        else:
+            with open(path, "r") as f:
+                data = f.read()
+        self.cache.put(path, decrypt, signature, data)
+        return data
+
+    def append_record(self, file_name, data):  # Append an encrypted record as a new line at the end of a file
+        file_name = DatabaseManager.generate_filename(file_name)
+        with open(file_name, "a") as f:
+            f.write(base64.b64encode(self.encrypt(data)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.cache.invalidate(file_name)
 
-    def read(self, file_name, decrypt=True):  # Get data from a file
+    def write_records(self, file_name, records):  # Atomically replace a file with the given encrypted records
         file_name = DatabaseManager.generate_filename(file_name)
-        data = ""
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "w") as f:
+            for data in records:
+                f.write(base64.b64encode(self.encrypt(data)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_name, file_name)
+        self.cache.invalidate(file_name)
+
+    def read_records(self, file_name):  # Return the decrypted records of a file, skipping the corrupted ones
+        file_name = DatabaseManager.generate_filename(file_name)
+        records = []
         with open(file_name, "r") as f:
-            data = f.read()
-        if decrypt:
-            data = self.decrypt(data)
-        return data
+            for line in f:
+                line = line.strip()
+                if line == "":
+                    continue
+                try:
+                    records.append(self.decrypt(base64.b64decode(line)))
+                except (TypeError, ValueError, IndexError):  # Half written record, e.g. after a crash
+                    self.logger.warning("Skipped a corrupted record in " + file_name)
+        return records
+
+    def record_store(self, file_name):  # Return the line indexed store of a file
+        store = self.record_stores.get(file_name)
+        if store is None:
+            store = RecordStore(self, file_name)
+            self.record_stores[file_name] = store
+        return store
+
+    def object_store(self, file_name, schema_version=0):  # Return the encrypted object store of a file
+        store = self.object_stores.get(file_name)
+        if store is None:
+            store = ObjectStore(self, file_name, schema_version)
+            self.object_stores[file_name] = store
+        return store
+
+    def save_object(self, file_name, key, obj):  # Save an object under the given key
+        self.object_store(file_name).put(key, obj)
+
+    def load_object(self, file_name, key, default=None):  # Load the object saved under the given key
+        return self.object_store(file_name).get(key, default)
 
     def write_line(self, file_name, data, line, encrypt=True):  # Write data on a specified file line
+        if encrypt:
+            self.record_store(file_name).write(line, data.rstrip("\n"))
+            return
         txt = [e + "\n" for e in self.read(file_name, encrypt).split("\n")]
         if len(txt) < line + 1:
             txt += ["\n" for k in range(line - len(txt) + 1)]  # Add missing lines
@@ -81,6 +173,13 @@ class DatabaseManager:
         if not isinstance(line, list):
             line = [line]
             single_line = True
+        if decrypt:
+            store = self.record_store(file_name)
+            txt = [store.read(pos) for pos in line]
+            if None in txt:
+                self.logger.error("Invalid line number")
+                return None
+            return txt[0] if single_line else txt
         txt = self.read(file_name, decrypt).split("\n")
         if len(txt) <= max(line):
             self.logger.error("Invalid line number")
@@ -93,7 +192,7 @@ class DatabaseManager:
         keywords = self.read("keywords", False).split("\n")
         dictionary = OrderedDict()
         for line in keywords:
-            tmp_list = line.split(",")
+            tmp_list = line.split(",", 2)  # The description can contain commas
             for i in range(len(tmp_list)):
                 if tmp_list[i][0] == " ":
                     tmp_list[i] = tmp_list[i][1:]
@@ -112,16 +211,8 @@ class DatabaseManager:
             logging.warning("File name is not in the class dictionary")
         return file_name
 
-    # TODO encrypt pickle objects
-    # TODO debug pickle methods
-    @staticmethod
-    def save_object(file_name, obj):  # Save the given objects on file (overwrites the file)
-        file_name = DatabaseManager.generate_filename(file_name)
-        with open(file_name, 'wb') as output:
-            pickle.dump(obj, output, pickle.HIGHEST_PROTOCOL)
-
     @staticmethod
-    def load_object(file_name):  # Load all the objects from a file
+    def load_pickles(file_name):  # Load all the objects from a plain pickle file written by older versions
         file_name = DatabaseManager.generate_filename(file_name)
         with open(file_name, 'rb') as input:
             objs = []
@@ -132,12 +223,402 @@ class DatabaseManager:
                     break
         return objs
 
+    @staticmethod
+    def file_signature(path):  # Return what changes when a file is rewritten: inode, modification time and size
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
     @staticmethod
     def file_exist(file_name):  # Return true if the given file exists
         file_name = DatabaseManager.generate_filename(file_name)
         return os.path.isfile(file_name)
 
 
+class RecordStore:  # Encrypted file where every line is a record that can be read and replaced on its own
+    header = "DRS1"  # Marks the record store files
+    record_header = struct.Struct(">II")  # Encrypted record length, line number
+    compaction_ratio = 2  # Compact when the file has this many records per line
+
+    def __init__(self, database, file_name):
+        self.database = database  # Database manager, encrypts the records
+        self.file_name = file_name  # Database file name
+        self.path = DatabaseManager.generate_filename(file_name)  # File path
+        self.index = []  # Offset and length of the latest record of every line, None for the missing lines
+        self.records = 0  # Records in the file, replaced ones included
+        self.end = 0  # End of the last complete record, a crash can leave a partial record after it
+        self.signature = None  # File inode, modification time and size when the index was built
+        self.lock = Lock()  # Protects the index and the file
+
+    @staticmethod
+    def is_record_file(path):  # Return true if the file is a record store
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as f:
+            return f.read(len(RecordStore.header)) == RecordStore.header
+
+    def refresh(self):  # Rebuild the index if the file has been changed (the lock must be held)
+        if not os.path.isfile(self.path):
+            self.index, self.records, self.end, self.signature = [], 0, 0, None
+            return
+        signature = DatabaseManager.file_signature(self.path)
+        if signature == self.signature:
+            return
+        if not RecordStore.is_record_file(self.path):
+            self.migrate()
+            signature = DatabaseManager.file_signature(self.path)
+        self.index, self.records = [], 0
+        with open(self.path, "rb") as f:
+            offset = len(RecordStore.header)
+            f.seek(offset)
+            while True:
+                head = f.read(RecordStore.record_header.size)
+                if len(head) < RecordStore.record_header.size:
+                    break
+                length, line = RecordStore.record_header.unpack(head)
+                start = offset + RecordStore.record_header.size
+                if start + length > signature[2]:  # Partial record
+                    break
+                self.set_index(line, (start, length))
+                self.records += 1
+                offset = start + length
+                f.seek(offset)
+        self.end = offset
+        self.signature = signature
+
+    def set_index(self, line, entry):  # Point the line to a record
+        if line >= len(self.index):
+            self.index += [None] * (line - len(self.index) + 1)
+        self.index[line] = entry
+
+    def migrate(self):  # Convert a whole-file encrypted file to a record store
+        self.database.logger.info("Converting " + self.path + " to a record store")
+        lines = self.database.read(self.file_name).split("\n")
+        self.rewrite([RecordStore.pack(line, self.database.encrypt(data)) for line, data in enumerate(lines)])
+
+    def write_all(self, lines):  # Atomically replace all the lines
+        records = [RecordStore.pack(line, self.database.encrypt(data)) for line, data in enumerate(lines)]
+        with self.lock:
+            self.rewrite(records)
+            self.refresh()
+
+    @staticmethod
+    def pack(line, encrypted):  # Return a record as written on file
+        return RecordStore.record_header.pack(len(encrypted), line) + encrypted
+
+    def rewrite(self, records):  # Atomically replace the file with the given packed records
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(RecordStore.header)
+            for record in records:
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.signature = None
+        self.database.cache.invalidate(self.path)
+
+    def read(self, line):  # Return the given line, None if it doesn't exist
+        data = self.database.cache.get(self.path, ("line", line))
+        if data is not None:
+            return data
+        with self.lock:
+            self.refresh()
+            if not 0 <= line < len(self.index) or self.index[line] is None:
+                return None
+            data = self.read_entry(self.index[line])
+            self.database.cache.put(self.path, ("line", line), self.signature, data)
+            return data
+
+    def read_entry(self, entry):  # Decrypt the record at the given position (the lock must be held)
+        if entry is None:
+            return ""
+        with open(self.path, "rb") as f:
+            f.seek(entry[0])
+            return self.database.decrypt(f.read(entry[1]))
+
+    def read_all(self):  # Return all the lines
+        with self.lock:
+            self.refresh()
+            return [self.read_entry(entry) for entry in self.index]
+
+    def write(self, line, data):  # Replace a line, appending its new record at the end of the file
+        with self.lock:
+            self.refresh()
+            encrypted = self.database.encrypt(data)
+            if self.signature is None:  # New file
+                self.rewrite([])
+                self.refresh()
+            with open(self.path, "r+b") as f:
+                f.seek(self.end)
+                f.write(RecordStore.pack(line, encrypted))
+                f.truncate()  # Drop a partial record left by a crash
+                f.flush()
+                os.fsync(f.fileno())
+            self.set_index(line, (self.end + RecordStore.record_header.size, len(encrypted)))
+            self.end += RecordStore.record_header.size + len(encrypted)
+            self.records += 1
+            self.signature = DatabaseManager.file_signature(self.path)
+            self.database.cache.invalidate(self.path)
+            if self.records > RecordStore.compaction_ratio * len(self.index):
+                self.compact()
+
+    def compact(self):  # Rewrite the file keeping only the latest record of every line (the lock must be held)
+        records = []
+        with open(self.path, "rb") as f:
+            for line, entry in enumerate(self.index):
+                if entry is not None:
+                    f.seek(entry[0])
+                    records.append(RecordStore.pack(line, f.read(entry[1])))  # Copied without decrypting
+        self.rewrite(records)
+        self.refresh()
+
+
+class ObjectStore:  # Encrypted pickled objects, one record each, loaded and updated by key
+    version = 1  # Object store format version
+    header_line = 0  # Line of the header, the objects follow
+
+    def __init__(self, database, file_name, schema_version=0):
+        self.logger = logging.getLogger("DomoRoom-object_store")  # Default logger
+        self.file_name = file_name  # Database file name
+        self.schema_version = schema_version  # Version of the saved objects, chosen by the owner
+        self.store = database.record_store(file_name)  # Records holding the header and the objects
+        self.lock = Lock()  # Serializes the header updates
+
+    def is_legacy(self):  # Return true if the file is a plain pickle file written by older versions
+        return os.path.isfile(self.store.path) and not RecordStore.is_record_file(self.store.path)
+
+    def read_header(self):  # Return the header: versions, key lines and free lines
+        if self.is_legacy():
+            self.logger.warning(self.store.path + " is a legacy pickle file, import its objects first")
+            data = None
+        else:
+            data = self.store.read(ObjectStore.header_line)
+        if not data:
+            return self.new_header()
+        header = json.loads(data)
+        if header["version"] > ObjectStore.version:
+            raise ValueError("Unsupported object store version: " + str(header["version"]))
+        if header["schema_version"] != self.schema_version:
+            self.logger.warning(self.store.path + " objects have schema version " + str(header["schema_version"]) +
+                                ", expected " + str(self.schema_version))
+        return header
+
+    def new_header(self):  # Return the header of an empty store
+        return {"version": ObjectStore.version, "schema_version": self.schema_version, "keys": {}, "free": []}
+
+    def keys(self):  # Return the saved keys, ordered by record line
+        keys = self.read_header()["keys"]
+        return sorted(keys, key=keys.get)
+
+    def get(self, key, default=None):  # Load a single object
+        line = self.read_header()["keys"].get(key)
+        if line is None:
+            return default
+        return pickle.loads(self.store.read(line))
+
+    def items(self):  # Iterate over the (key, object) pairs, loading one object at a time
+        for key in self.keys():
+            yield key, self.get(key)
+
+    def put(self, key, obj):  # Save or replace a single object
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            header = self.read_header()
+            line = header["keys"].get(key)
+            if line is not None:
+                self.store.write(line, data)
+                return
+            line = header["free"].pop() if header["free"] else len(header["keys"]) + len(header["free"]) + 1
+            header["keys"][key] = line
+            self.store.write(line, data)  # A crash before the header update only leaves an unreferenced record
+            self.store.write(ObjectStore.header_line, json.dumps(header))
+
+    def delete(self, key):  # Remove a single object, return false if the key doesn't exist
+        with self.lock:
+            header = self.read_header()
+            line = header["keys"].pop(key, None)
+            if line is None:
+                return False
+            header["free"].append(line)
+            self.store.write(ObjectStore.header_line, json.dumps(header))
+            self.store.write(line, "")
+            return True
+
+    def replace_all(self, items):  # Atomically replace the whole store with the given (key, object) pairs
+        header = self.new_header()
+        lines = [None]
+        for key, obj in items:
+            header["keys"][key] = len(lines)
+            lines.append(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+        lines[ObjectStore.header_line] = json.dumps(header)
+        with self.lock:
+            self.store.write_all(lines)
+
+
+class ContentCache:  # LRU cache of decrypted file contents, checked against the file signature on every hit
+    def __init__(self, max_size=4 * 1024 * 1024):
+        self.max_size = max_size  # Maximum cached bytes
+        self.size = 0  # Cached bytes
+        self.entries = OrderedDict()  # (path, part): (file signature, data), least recently used first
+        self.parts = {}  # Cached parts of every path
+        self.hits = 0  # Reads served from memory
+        self.misses = 0  # Reads that had to go to the disk
+        self.evictions = 0  # Entries dropped to stay under max_size
+        self.lock = Lock()  # Protects the entries
+
+    def get(self, path, part):  # Return the cached data, None if missing or if the file has changed
+        key = (path, part)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                try:
+                    signature = DatabaseManager.file_signature(path)
+                except OSError:
+                    signature = None
+                if entry[0] == signature:
+                    self.entries[key] = entry  # Most recently used
+                    self.hits += 1
+                    return entry[1]
+                self.forget(key, entry)
+            self.misses += 1
+        return None
+
+    def put(self, path, part, signature, data):  # Cache data read when the file had the given signature
+        if len(data) > self.max_size:
+            return
+        key = (path, part)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.forget(key, entry)
+            self.entries[key] = (signature, data)
+            self.parts.setdefault(path, set()).add(part)
+            self.size += len(data)
+            while self.size > self.max_size:
+                old_key, old_entry = self.entries.popitem(last=False)
+                self.forget(old_key, old_entry)
+                self.evictions += 1
+
+    def forget(self, key, entry):  # Update the counters of a removed entry (the lock must be held)
+        self.size -= len(entry[1])
+        parts = self.parts.get(key[0])
+        if parts is not None:
+            parts.discard(key[1])
+            if not parts:
+                del self.parts[key[0]]
+
+    def invalidate(self, path):  # Drop every cached part of a file
+        with self.lock:
+            for part in list(self.parts.get(path, ())):
+                key = (path, part)
+                self.forget(key, self.entries.pop(key))
+
+    def stats(self):  # Return the cache counters
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "size": self.size}
+
+
+class EncryptedWriter:  # Encrypts the written data chunk by chunk
+    def __init__(self, output, database):
+        self.output = output  # Destination file
+        initialization_vector = os.urandom(AES.block_size)
+        self.encryptor = database.init_encryptor(database.key, initialization_vector)  # Stream encryptor
+        self.buffer = ""  # Data not encrypted yet
+        self.output.write(DatabaseManager.header + initialization_vector)
+
+    def write(self, data):  # Encrypt and write the complete chunks, keep the rest for later
+        self.buffer += data
+        if len(self.buffer) >= DatabaseManager.chunk_size:
+            end = len(self.buffer) - len(self.buffer) % AES.block_size
+            self.output.write(self.encryptor.encrypt(self.buffer[:end]))
+            self.buffer = self.buffer[end:]
+
+    def close(self):  # Pad and write the last block, then close the file
+        if self.output.closed:
+            return
+        self.output.write(self.encryptor.encrypt(DatabaseManager.pad(self.buffer)))
+        self.buffer = ""
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class EncryptedReader:  # Decrypts the file chunk by chunk
+    def __init__(self, source, database):
+        self.source = source  # Encrypted file
+        self.database = database  # Database manager, used for the legacy format
+        self.buffer = ""  # Decrypted data not read yet
+        self.tail = ""  # Last decrypted block, it holds the padding until the end of the file
+        self.remainder = source.read(len(DatabaseManager.header))  # Encrypted data shorter than a block
+        self.legacy = self.remainder != DatabaseManager.header  # Written by an older version
+        if self.legacy:
+            self.decryptor = database.init_encryptor(database.key)
+        else:
+            self.decryptor = database.init_encryptor(database.key, source.read(AES.block_size))
+            self.remainder = ""
+        self.eof = False  # Has the whole file been decrypted?
+
+    def fill(self):  # Decrypt the next chunk
+        chunk = self.source.read(DatabaseManager.chunk_size)
+        if chunk == "":
+            self.eof = True
+            if self.legacy:
+                self.buffer += self.tail.rstrip(self.database.filler_character)
+            else:
+                self.buffer += DatabaseManager.unpad(self.tail)
+            self.tail = ""
+            return
+        data = self.remainder + chunk
+        end = len(data) - len(data) % AES.block_size
+        self.remainder = data[end:]
+        plain = self.tail + self.decryptor.decrypt(data[:end])
+        if self.legacy:  # Filler characters can span more than a block
+            stripped = plain.rstrip(self.database.filler_character)
+            cut = min(len(stripped), max(len(plain) - AES.block_size, 0))
+        else:
+            cut = max(len(plain) - AES.block_size, 0)
+        self.buffer += plain[:cut]
+        self.tail = plain[cut:]
+
+    def read(self, size=-1):  # Return up to size decrypted bytes, the whole file if size is negative
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.fill()
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def readline(self):  # Return the next line, including the line terminator
+        while not self.eof and "\n" not in self.buffer:
+            self.fill()
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        line = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if line == "":
+                break
+            yield line
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     manager = DatabaseManager("key").file_exist("telegram")
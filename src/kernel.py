@@ -10,6 +10,7 @@ import control_panel
 import routines
 import camera_manager
 import remote_devices
+import runtime
 
 
 # TODO manage random errors (404)
@@ -29,17 +30,19 @@ class Kernel:
 
         key = raw_input("Insert the key: ")  # TODO verify & hide the key
         self.database_manager = database_manager.DatabaseManager(key)
-        self.camera_manager = camera_manager.CameraManager(self)
-        self.telegram_manager = telegram_manager.TelegramManager(self)
-        self.control_panel = control_panel.ControlPanel(self)
-        self.remote_devices = remote_devices.RemoteDevices(self)
+        self.runtime = runtime.Runtime()  # Starts, supervises and stops the subsystems
+        self.camera_manager = self.runtime.start("camera", camera_manager.CameraManager, self)
+        self.telegram_manager = self.runtime.start("telegram", telegram_manager.TelegramManager, self)
+        self.control_panel = self.runtime.start("control_panel", control_panel.ControlPanel, self)
+        self.remote_devices = self.runtime.start("devices", remote_devices.RemoteDevices, self)
         self.data_mining = None
         self.integrity_system = None
-        self.routines = routines.RoutinesManager(self)
+        self.routines = self.runtime.start("routines", routines.RoutinesManager, self)
         self.remote_controller = None
 
-    def __del__(self):
+    def shut_down(self):  # Stop the subsystems in reverse startup order
         logging.info("Shutting down kernel")
+        self.runtime.stop()
 
     @staticmethod
     def init_logging(file_name=""):  # Initialize console logging
@@ -51,4 +54,8 @@ class Kernel:
 
 
 if __name__ == "__main__":
-    Kernel(verbose=False)
+    kernel = Kernel(verbose=False)
+    try:
+        kernel.runtime.wait()  # The subsystems run on their own threads until the shut down
+    except KeyboardInterrupt:
+        kernel.control_panel.shut_down()
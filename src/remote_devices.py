@@ -4,9 +4,17 @@
 #   Url: https://github.com/AlessandroTaufer
 #
 import logging
+import heapq
+import itertools
 import requests
+import runtime
 import database_manager
-import time  # TODO check if import time is useless
+import sensors
+import time
+import worker_pool
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from threading import Condition, RLock
 
 
 class RemoteDevices:
@@ -14,42 +22,137 @@ class RemoteDevices:
     def __init__(self, parent):
         self.parent = parent
         self.logger = logging.getLogger("DomoRoom-RemoteDevices")
-        self.devices = []
+        self.devices = DeviceRegistry()  # Devices indexed by id, name and address
+        self.client = HttpClient()  # Keep-alive connections to the devices
+        EspEasyDevice.client = self.client
+        self.monitor = DeviceMonitor(self.client)  # Probes the devices and caches their state
+        EspEasyDevice.monitor = self.monitor
+        self.store = self.parent.database_manager.object_store("devices")  # Saved devices, one per key
+        self.groups_store = self.parent.database_manager.object_store("groups")  # Saved groups, one per key
+        self.groups = dict(self.groups_store.items())  # Device names of every group
+        self.command_timeout = 15  # Seconds a batch command waits for the devices
+        self.sensor_store = sensors.TimeSeriesStore()  # Sensor samples history
+        self.sampler = sensors.SensorSampler(self.sensor_store)  # Reads the sensors
         self.load_devices()
 
-    def __del__(self):
+    def stop(self):  # Stop probing and sampling, save the devices
         # TODO warn devices that the core is shutting down
+        self.monitor.stop()
+        self.sampler.stop()
+        self.client.pool.stop()
         self.backup_devices()
 
     def add_device(self, device):  # Add a device to the device list
-        if device is not None and device not in self.devices:
-            self.devices.append(device)
+        if device is not None and self.devices.add(device):
+            self.store.put(device.name, device)
+            self.watch(device)
             return True
         self.logger.warning("Invalid device parameter as add_device method")
         return False
 
-    def del_device(self, device):  # Remove a device from the device list
-        if isinstance(device, int):
-            self.devices.pop(device)
-            return True
-        elif device in self.devices:
-            del self.devices[self.devices.index(device, 0, len(self.devices))] # TODO check if del device works
+    def del_device(self, device):  # Remove a device by object, id, name or address
+        device = self.devices.remove(device)
+        if device is not None:
+            self.store.delete(device.name)
+            self.monitor.unwatch(device)
+            if isinstance(device, Sensor):
+                self.sampler.remove_sensor(device)
             return True
         self.logger.warning("Deleting an invalid device ")
         return False
 
-    def get_device(self, pos):  # Return the device at the give position
-        if pos >= 0 < len(self.devices):
-            return self.devices[pos]
+    def watch(self, device):  # Start the background monitoring/sampling of a device
+        self.monitor.watch(device)
+        if isinstance(device, Sensor):
+            self.sampler.add_sensor(device)
+
+    def get_device(self, key):  # Return the device with the given id, name or address, None if missing
+        return self.devices.get(key)
+
+    def devices_to_string(self):  # Return the devices with their last known state, without contacting them
+        if len(self.devices) == 0:
+            return "Currently there are not devices"
+        return "Devices:\n" + "\n".join(self.monitor.state_to_string(device) for device in self.devices)
+
+    def find_device(self, name):  # Return the device with the given name, None if missing
+        return self.devices.get_by_name(name)
+
+    def set_group(self, group, device_names):  # Create or replace a named group of devices
+        self.groups[group] = list(device_names)
+        self.groups_store.put(group, self.groups[group])
+
+    def del_group(self, group):  # Remove a group, the devices are kept
+        if self.groups.pop(group, None) is None:
+            return False
+        self.groups_store.delete(group)
+        return True
+
+    def resolve(self, targets):  # Return the devices of a group name, a device name, a device or a list of them
+        if isinstance(targets, basestring):
+            if targets in self.groups:
+                targets = self.groups[targets]
+            else:
+                targets = [targets]
+        elif not isinstance(targets, (list, tuple, set)):
+            targets = [targets]
+        devices = []
+        for target in targets:
+            device = self.find_device(target) if isinstance(target, basestring) else target
+            if device is None:
+                self.logger.warning("Unknown device: " + str(target))
+            elif device not in devices:
+                devices.append(device)
+        return devices
+
+    def batch_command(self, targets, commands):  # Send the commands to all the target devices concurrently
+        start = time.time()
+        result = BatchResult()
+        tasks = []
+        for device in self.resolve(targets):
+            if not isinstance(device, EspEasyDevice):
+                self.logger.warning("Device " + device.name + " doesn't accept commands")
+                result.results[device.name] = False
+                continue
+            tasks += [(device, task) for task in device.send_commands_async(commands)]
+        deadline = start + self.command_timeout
+        for device, task in tasks:
+            done = task.wait(max(deadline - time.time(), 0)) and task.error is None and task.result is True
+            result.results[device.name] = result.results.get(device.name, True) and done
+            latency = (task.finished or time.time()) - task.submitted
+            result.latencies[device.name] = max(result.latencies.get(device.name, 0), latency)
+        result.elapsed = time.time() - start
+        return result
+
+    def group_gpio_write(self, targets, pin, status, duration=0):  # Set a pin on all the target devices
+        return self.batch_command(targets, [EspEasyDevice.gpio_command(pin, status, duration)])
 
     def backup_devices(self, filename="devices"):  # Save all the devices on file
         self.logger.debug("Saving devices on file: " + filename)
-        database_manager.DatabaseManager.save_object(filename, self.devices)
+        store = self.parent.database_manager.object_store(filename)
+        store.replace_all([(device.name, device) for device in self.devices])
         self.logger.info("Devices saved on file: " + filename)
 
     def load_devices(self, filename="devices"):  # Load devices from a previous backup
         if database_manager.DatabaseManager.file_exist(filename):
-            self.devices = self.devices + database_manager.DatabaseManager.load_object(filename)[0]
+            store = self.parent.database_manager.object_store(filename)
+            legacy = store.is_legacy()
+            if legacy:  # Plain pickle of the devices list
+                devices = database_manager.DatabaseManager.load_pickles(filename)[0]
+            else:
+                devices = [device for key, device in store.items()]
+            new_ids = [device for device in devices if device.id is None]  # Numbered after the saved ids are taken
+            for device in [device for device in devices if device.id is not None] + new_ids:
+                if self.devices.add(device):
+                    self.watch(device)
+                else:
+                    self.logger.warning("Skipped duplicated device: " + str(device.name))
+            if legacy:
+                self.backup_devices(filename)  # Saved with their ids
+                self.logger.info("Converted devices file to an encrypted object store")
+            else:
+                for device in new_ids:
+                    if self.devices.get(device.id) is device:
+                        store.put(device.name, device)  # Keep the new id across restarts
             self.logger.info("Successfully loaded devices from file: " + filename)
             return True
         else:
@@ -57,8 +160,278 @@ class RemoteDevices:
         return False
 
 
+class DeviceRegistry:  # Thread safe device collection indexed by id, name and address
+    def __init__(self):
+        self.by_id = OrderedDict()  # Id: device, in insertion order
+        self.by_name = {}  # Name: device
+        self.by_address = {}  # Ip address: device
+        self.next_id = 0  # Id given to the next device without one
+        self.lock = RLock()  # Serializes the changes
+
+    def add(self, device):  # Add a device, giving it a stable id if it has none; false if it clashes with another
+        with self.lock:
+            if device.id in self.by_id or device.name in self.by_name or device.ip_address in self.by_address:
+                return False
+            if device.id is None:
+                device.id = self.next_id
+            self.by_id[device.id] = device
+            self.by_name[device.name] = device
+            self.by_address[device.ip_address] = device
+            self.next_id = max(self.next_id, device.id + 1)
+            return True
+
+    def remove(self, key):  # Remove a device by object, id, name or address, return it (None if missing)
+        with self.lock:
+            device = key if isinstance(key, Device) else self.get(key)
+            if device is None or self.by_id.get(device.id) is not device:
+                return None
+            del self.by_id[device.id]
+            del self.by_name[device.name]
+            del self.by_address[device.ip_address]
+            return device
+
+    def get(self, key):  # Return the device with the given id, name or address, None if missing
+        if isinstance(key, basestring) and key.isdigit() and int(key) in self.by_id:
+            return self.by_id[int(key)]
+        if isinstance(key, (int, long)):
+            return self.by_id.get(key)
+        return self.by_name.get(key) or self.by_address.get(key)
+
+    def get_by_name(self, name):  # Return the device with the given name, None if missing
+        return self.by_name.get(name)
+
+    def get_by_address(self, ip_address):  # Return the device with the given ip address, None if missing
+        return self.by_address.get(ip_address)
+
+    def __iter__(self):  # Iterate over a snapshot, the registry can change meanwhile
+        with self.lock:
+            return iter(list(self.by_id.values()))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, device):
+        return self.by_id.get(getattr(device, "id", None)) is device
+
+
+class BatchResult:  # Outcome of a command sent to many devices
+    def __init__(self):
+        self.results = {}  # Device name: true if all its commands succeeded
+        self.latencies = {}  # Device name: seconds between the submission and the last reply
+        self.elapsed = 0  # Seconds to complete the whole batch
+
+    def succeeded(self):  # Return true if every device succeeded
+        return all(self.results.values())
+
+    def to_string(self):  # Return a readable summary
+        txt = "Batch completed in %.2fs\n" % self.elapsed
+        for name in sorted(self.results):
+            txt += name + ": " + ("ok" if self.results[name] else "failed")
+            if name in self.latencies:
+                txt += " (%.2fs)" % self.latencies[name]
+            txt += "\n"
+        return txt
+
+
+class HttpClient:  # Shared keep-alive HTTP client, sends the device commands concurrently
+    def __init__(self, connect_timeout=2, read_timeout=5, retries=2, backoff=0.2, connections_per_device=2,
+                 workers=8):
+        self.logger = logging.getLogger("DomoRoom-http_client")  # Default logger
+        self.connect_timeout = connect_timeout  # Seconds to open a connection
+        self.read_timeout = read_timeout  # Seconds to wait for the reply
+        self.retries = retries  # Attempts after the first failed one
+        self.backoff = backoff  # Seconds before the first retry, doubled every attempt
+        self.connections_per_device = connections_per_device  # Maximum open connections to a single device
+        self.session = requests.Session()  # Reuses the connections between commands
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=connections_per_device, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.pool = worker_pool.WorkerPool("http_client", size=workers,
+                                           subsystem="devices")  # Sends the asynchronous requests
+        self.pool.default_key_limit = connections_per_device
+
+    def post(self, url):  # Send a request, retrying with backoff, return true if the device replied with 200
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.post(url, timeout=(self.connect_timeout, self.read_timeout))
+                return r.status_code == 200
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    self.logger.warning("Request to " + url + " failed: " + str(e))
+                    return False
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def post_async(self, url, key=None):  # Send a request on the worker pool, return a Task
+        return self.pool.submit(self.post, (url,), key, name=url)
+
+    def probe(self, url):  # Single attempt GET, return (reachable, decoded json or None)
+        try:
+            r = self.session.get(url, timeout=(self.connect_timeout, self.read_timeout))
+        except requests.RequestException:
+            return False, None
+        try:
+            return True, r.json()
+        except ValueError:  # Reachable, but older firmwares have no json page
+            return True, None
+
+
+class DeviceMonitor:  # Probes the devices in background and caches their last known state
+    def __init__(self, client, min_interval=5, max_interval=120, failures_threshold=2):
+        self.logger = logging.getLogger("DomoRoom-device_monitor")  # Default logger
+        self.client = client  # HTTP client, its worker pool runs the probes
+        self.min_interval = min_interval  # Seconds between probes after a status change
+        self.max_interval = max_interval  # Seconds between probes of a stable device
+        self.failures_threshold = failures_threshold  # Consecutive failures before marking a device down
+        self.states = {}  # Device name: DeviceState
+        self.queue = []  # Min-heap of (probe time, sequence, device, state generation)
+        self.sequence = itertools.count()  # Heap tie breaker
+        self.condition = Condition()  # Protects the states and wakes up the monitor
+        self.enabled = True  # Monitor status
+        runtime.spawn("devices", self.behaviour, name="device monitor")
+
+    def watch(self, device):  # Start probing a device
+        if not isinstance(device, EspEasyDevice):
+            return
+        with self.condition:
+            self.states[device.name] = DeviceState()
+            self.schedule(device, 0)
+
+    def unwatch(self, device):  # Stop probing a device
+        with self.condition:
+            self.states.pop(device.name, None)  # Its heap entries are dropped when they reach the top
+
+    def schedule(self, device, delay):  # Plan the next probe, replacing the planned one (the condition must be held)
+        state = self.states[device.name]
+        state.generation += 1
+        heapq.heappush(self.queue, (time.time() + delay, next(self.sequence), device, state.generation))
+        self.condition.notify()
+
+    def stop(self):  # Stop the monitor thread
+        with self.condition:
+            self.enabled = False
+            self.condition.notify()
+
+    def behaviour(self):  # Hand the due probes to the client worker pool
+        while self.enabled:
+            with self.condition:
+                while self.queue:
+                    probe_time, sequence, device, generation = self.queue[0]
+                    state = self.states.get(device.name)
+                    if state is not None and state.generation == generation:
+                        break
+                    heapq.heappop(self.queue)  # Removed device or replaced probe
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                delay = self.queue[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                runtime.record_lag("devices", -delay)
+                device = heapq.heappop(self.queue)[2]
+            self.client.pool.submit(self.probe, (device,), device.ip_address, name="probe " + device.name)
+
+    def probe(self, device):  # Contact the device and update its state
+        reachable, data = self.client.probe(device.json_url())
+        with self.condition:
+            state = self.states.get(device.name)
+            if state is None:
+                return
+            changed = self.update(device, state, reachable)
+            if data is not None:
+                state.update_sensors(data)
+            if changed:
+                state.interval = self.min_interval
+            else:
+                state.interval = min(max(state.interval * 2, self.min_interval), self.max_interval)
+            self.schedule(device, state.interval)
+
+    def update(self, device, state, reachable):  # Update the device status, return true if it changed
+        now = time.time()
+        state.last_probe = now
+        previous = state.status
+        if reachable:
+            state.failures = 0
+            state.last_seen = now
+            state.status = DeviceState.UP
+        else:
+            state.failures += 1
+            if state.failures >= self.failures_threshold:
+                state.status = DeviceState.DOWN
+        if state.status != previous:
+            self.logger.info("Device " + device.name + " is " + state.status)
+            return True
+        return False
+
+    def report(self, device, reachable, command=None):  # Update the state after a command sent to the device
+        with self.condition:
+            state = self.states.get(device.name)
+            if state is None:
+                return
+            if self.update(device, state, reachable):
+                state.interval = self.min_interval
+                self.schedule(device, state.interval)  # Confirm the status change soon
+            if reachable and command is not None:
+                state.update_pins(command, device.command_separator)
+
+    def is_down(self, device):  # Return true if the device is known to be unreachable
+        state = self.states.get(device.name)
+        return state is not None and state.status == DeviceState.DOWN
+
+    def get_state(self, device):  # Return the cached state of the device, None if not monitored
+        return self.states.get(device.name)
+
+    def state_to_string(self, device):  # Return a readable description of the cached device state
+        txt = str(device.id) + " - " + device.name + " (" + str(device.ip_address) + ")"
+        state = self.states.get(device.name)
+        if state is None:
+            return txt + ": not monitored"
+        return txt + ": " + state.to_string()
+
+
+class DeviceState:  # Last known state of a remote device
+    UNKNOWN = "unknown"
+    UP = "up"
+    DOWN = "down"
+
+    def __init__(self):
+        self.status = DeviceState.UNKNOWN  # Reachability
+        self.failures = 0  # Consecutive failed probes/commands
+        self.last_probe = None  # Time of the last probe or command
+        self.last_seen = None  # Time of the last successful probe or command
+        self.interval = 0  # Seconds until the next probe
+        self.generation = 0  # Identifies the planned probe
+        self.pins = {}  # Pin: (value, time)
+        self.sensors = {}  # "task.value" name: (value, time)
+
+    def update_pins(self, command, separator=None):  # Remember the pins set by a GPIO/PWM command
+        now = time.time()
+        for single in command.split(separator) if separator else [command]:
+            fields = single.split(",")
+            if len(fields) >= 3 and fields[0] in ("GPIO", "PWM"):
+                self.pins[fields[1]] = (fields[2], now)
+
+    def update_sensors(self, data):  # Store the sensor values of an Esp Easy json page
+        now = time.time()
+        for sensor in data.get("Sensors", []):
+            for value in sensor.get("TaskValues", []):
+                name = str(sensor.get("TaskName")) + "." + str(value.get("Name"))
+                self.sensors[name] = (value.get("Value"), now)
+
+    def to_string(self):  # Return a readable description
+        txt = self.status
+        if self.last_seen is not None:
+            txt += ", seen " + str(int(time.time() - self.last_seen)) + "s ago"
+        if self.pins:
+            txt += ", pins: " + ", ".join(pin + "=" + str(value[0]) for pin, value in sorted(self.pins.items()))
+        if self.sensors:
+            txt += ", sensors: " + ", ".join(name + "=" + str(value[0]) for name, value in sorted(self.sensors.items()))
+        return txt
+
+
 class Device:
     # TODO Device needs implementation
+    id = None  # Stable identifier given by the registry, devices saved by older versions get one on load
+
     def __init__(self, name, ip_address, port):
         self.name = name
         self.ip_address = ip_address
@@ -69,28 +442,58 @@ class Device:
 
 
 class EspEasyDevice(Device):  # Interface with an Esp Easy module
+    client = None  # Shared HTTP client, not saved with the device
+    monitor = None  # Shared device monitor, not saved with the device
+    command_separator = None  # Joins several commands in one request, for firmwares that support it
+
     def __init__(self, name,ip_address):
         Device.__init__(self, name, ip_address, None)
         self.url = "http://" + ip_address + "/control?cmd="
 
     def gpio_write(self, pin, status, duration=0):  # Set the remote pin at the status level
+        return self.send_command(self.gpio_command(pin, status, duration))
+
+    def gpio_write_async(self, pin, status, duration=0):  # Set the remote pin without waiting, return a Task
+        return self.send_command_async(self.gpio_command(pin, status, duration))
+
+    @staticmethod
+    def gpio_command(pin, status, duration=0):  # Return the command that sets the pin at the status level
         if isinstance(pin, basestring):
-            pin = self.digital_to_gpio(pin)
+            pin = EspEasyDevice.digital_to_gpio(pin)
         status = int(status)
         command = "GPIO,"
         command += str(pin) + "," + str(status)
         if status > 1:
             command = command.replace("GPIO", "PWM")
             command += "," + str(duration)
-        return self.send_command(command)
+        return command
 
-    def send_command(self, command):  # Send a command to the remote device
-        try:
-            r = requests.post(self.url+command)
-            if r.status_code == 200:
-                return True
-        except:
+    def send_command(self, command):  # Send a command to the remote device, fail fast if it is down
+        monitor = EspEasyDevice.monitor
+        if monitor is not None and monitor.is_down(self):
+            logging.getLogger("DomoRoom-RemoteDevices").debug("Device " + self.name + " is down, command dropped")
             return False
+        result = EspEasyDevice.get_client().post(self.url + command)
+        if monitor is not None:
+            monitor.report(self, result, command)
+        return result
+
+    def send_command_async(self, command):  # Send a command on the client worker pool, return a Task
+        return EspEasyDevice.get_client().pool.submit(self.send_command, (command,), self.ip_address, name=command)
+
+    def json_url(self):  # Return the url of the device status page
+        return "http://" + self.ip_address + "/json"
+
+    def send_commands_async(self, commands):  # Send many commands, in a single request if supported, return Tasks
+        if self.command_separator is not None and len(commands) > 1:
+            return [self.send_command_async(self.command_separator.join(commands))]
+        return [self.send_command_async(command) for command in commands]
+
+    @staticmethod
+    def get_client():  # Return the shared HTTP client, creating it on first use
+        if EspEasyDevice.client is None:
+            EspEasyDevice.client = HttpClient()
+        return EspEasyDevice.client
 
     @staticmethod
     def digital_to_gpio(digital_pin):  # Convert a digital pin to GPIO
@@ -120,26 +523,52 @@ class EspEasyDevice(Device):  # Interface with an Esp Easy module
 
 
 class Sensor(Device):
-    # TODO Sensor needs implementation
     '''
        Every device has some scripts to control itself. They are contained in a dictionary.
        Keywords that every device must have:
        setup, read
     '''
-    def __init__(self, ip_address, script):
-        Device.__init__(ip_address, script)
-        self.scripts["setup"]()
+    interval = 60  # Seconds between two samples
+
+    def __init__(self, name, ip_address, scripts, interval=60):
+        Device.__init__(self, name, ip_address, None)
+        self.scripts = scripts  # Setup and read scripts
+        self.interval = interval
+        if "setup" in self.scripts:
+            self.scripts["setup"]()
 
     def get_value(self):  # Get the sensor value
         return self.scripts["read"]()
 
 
+class EspEasySensor(Sensor):  # Value of an Esp Easy task, read from the device json page
+    def __init__(self, name, ip_address, task_name, value_name, interval=60):
+        Sensor.__init__(self, name, ip_address, {}, interval)
+        self.task_name = task_name  # Esp Easy task name
+        self.value_name = value_name  # Task value name
+
+    def get_value(self):  # Get the sensor value, None if the device is unreachable
+        reachable, data = EspEasyDevice.get_client().probe("http://" + self.ip_address + "/json")
+        if data is None:
+            return None
+        for sensor in data.get("Sensors", []):
+            if sensor.get("TaskName") == self.task_name:
+                for value in sensor.get("TaskValues", []):
+                    if value.get("Name") == self.value_name:
+                        return value.get("Value")
+        return None
+
+
 if __name__ == "__main__":
-    # while True:
-
-    manager = RemoteDevices(None)
-    manager.load_devices()
-    # manager.add_device(dev)
-    print("Devices: " + str(manager.devices))
-    manager.get_device(0).gpio_write("D5", 700)
-    manager.backup_devices()
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    class Parent:  # Minimal kernel, the devices only need the database
+        def __init__(self, key):
+            self.database_manager = database_manager.DatabaseManager(key)
+
+    manager = RemoteDevices(Parent(raw_input("Insert the key: ")))  # Loads the saved devices
+    print("Devices: " + manager.devices_to_string())
+    device = manager.get_device(0)
+    if device is not None:
+        device.gpio_write("D5", 700)
+    manager.stop()
@@ -5,7 +5,16 @@
 #
 import logging
 import datetime
-from threading import Thread
+import bisect
+import heapq
+import itertools
+import json
+import uuid
+import runtime
+import database_manager
+import worker_pool
+from collections import OrderedDict
+from threading import Condition
 
 
 class RoutinesManager:
@@ -14,59 +23,180 @@ class RoutinesManager:
         self.logger = logging.getLogger("DomoRoom-routine_manager")  # Default logger
         self.logger.info("Initializing RoutinesManager...")
         self.routines = []  # Routines
+        self.queue = []  # Min-heap of (time, sequence, routine) entries, ordered by the next run time
+        self.sequence = itertools.count()  # Heap tie breaker, keeps routines with the same time in insertion order
+        self.condition = Condition()  # Wakes up the scheduler when the routines change
+        self.misfire_grace = datetime.timedelta(seconds=1)  # How late a routine can run before it counts as misfired
+        self.pool = worker_pool.WorkerPool("routines", size=4, default_timeout=60)  # Runs the due routines
+        self.actions = {}  # Named scripts that routines can be saved with
+        self.register_default_actions()
+        self.journal = None  # Routines backup
+        if parent is not None and parent.database_manager is not None:
+            self.journal = RoutineJournal(parent.database_manager)
+            self.load_routines()
         self.enabled = True  # Routine manager status
-        Thread(target=self.behaviour, args=()).start()
+        runtime.spawn("routines", self.behaviour, name="routines scheduler")
         self.logger.info("Successfully initialized RoutinesManager")
 
-    def behaviour(self):  # Check if some routines have to run
-        while self.enabled:  # TODO backup routines
-            for routine in self.routines:
-                if routine.time < datetime.datetime.now():
-                    try:
-                        routine.run()  # TODO manage repeat option
-                        self.remove_routine(routine)
-                        self.logger.info("Successfully executed '" + routine.name + "' routine")
+    def register_action(self, name, script):  # Register a script that saved routines can refer to by name
+        self.actions[name] = script
 
-                    except:
-                        self.logger.error("Failed to run '" + routine.name + "' routine")
+    def register_default_actions(self):  # Register the kernel scripts
+        self.register_action("telegram_broadcast", lambda text: self.parent.telegram_manager.broadcast_message(text))
+        self.register_action("telegram_send", lambda chat, text: self.parent.telegram_manager.send_message(chat, text))
 
-    def add_routine(self, name, time, script, script_args=(), repeat=False):  # Add a routine to the routines list
-        routine = Routine(name, time, script, script_args, repeat)
-        self.routines.append(routine)
+    def load_routines(self):  # Load the routines from the journal
+        with self.condition:
+            for record in self.journal.load():
+                try:
+                    routine = Routine.from_record(record, self.actions)
+                except (KeyError, ValueError):
+                    self.logger.warning("Could not load routine '" + str(record.get("name")) + "'")
+                    continue
+                routine.scheduled = True
+                self.routines.append(routine)
+                self.queue.append((routine.time, next(self.sequence), routine))
+            heapq.heapify(self.queue)
+            self.journal.compact(self.routines)
+        self.logger.info("Loaded " + str(len(self.routines)) + " routines")
+
+    def persist(self, event, routine, next_time=None):  # Write a routine event on the journal
+        if self.journal is None or routine.action is None:
+            return
+        try:
+            if event == "add":
+                self.journal.add(routine)
+            elif event == "remove":
+                self.journal.remove(routine)
+            else:
+                self.journal.fired(routine, next_time)
+            if self.journal.needs_compaction(len(self.routines)):
+                self.journal.compact(self.routines)
+        except (IOError, OSError):
+            self.logger.error("Could not save the '" + routine.name + "' routine " + event + " event")
+
+    def behaviour(self):  # Sleep until the next routine is due, then hand it to the worker pool
+        while self.enabled:
+            with self.condition:
+                routine = self.next_due_routine()
+            if routine is not None:
+                self.pool.submit(self.run_routine, (routine,), routine.target, routine.timeout, routine.name)
+
+    def run_routine(self, routine):  # Run a routine, called by the worker pool
+        try:
+            routine.run()
+            self.logger.info("Successfully executed '" + routine.name + "' routine")
+        except:
+            self.logger.error("Failed to run '" + routine.name + "' routine")
+            raise
+
+    def next_due_routine(self):  # Pop the next due routine, wait and return None if none is due yet
+        while self.queue and not self.queue[0][2].scheduled:  # Drop the removed routines
+            heapq.heappop(self.queue)
+        if not self.queue:
+            self.condition.wait()  # Nothing scheduled, sleep until add_routine or stop
+            return None
+        delay = RoutinesManager.seconds_until(self.queue[0][0])
+        if delay > 0:
+            self.condition.wait(delay)  # Woken up earlier if the routines change
+            return None
+        runtime.record_lag("routines", -delay)
+        routine = heapq.heappop(self.queue)[2]
+        now = datetime.datetime.now()
+        misfired = routine.time + self.misfire_grace < now
+        if routine.misfire_policy == Routine.MISFIRE_RUN_ALL:
+            next_time = routine.next_time(routine.time)  # Missed runs pop up again one by one
+        else:
+            next_time = routine.next_time(now)  # Missed runs are collapsed in the current one
+        if next_time is None:
+            self.discard(routine)
+        else:
+            routine.time = next_time
+            self.schedule(routine)
+        self.persist("fired", routine, next_time)
+        if misfired and routine.misfire_policy == Routine.MISFIRE_SKIP:
+            self.logger.warning("Skipped misfired routine '" + routine.name + "'")
+            return None
+        return routine
+
+    def stop(self):  # Stop the scheduler thread
+        with self.condition:
+            self.enabled = False
+            self.condition.notify()
+        self.pool.stop()
+
+    # Add a routine to the routines list
+    def add_routine(self, name, time, script, script_args=(), repeat=False, misfire_policy=None, target=None,
+                    timeout=None):
+        action = None
+        if isinstance(script, basestring):  # Named action, the routine can be saved
+            action = script
+            if action not in self.actions:
+                raise ValueError("Unknown routine action: " + action)
+            script = self.actions[action]
+        routine = Routine(name, time, script, script_args, repeat, misfire_policy, target, timeout, action)
+        with self.condition:
+            self.routines.append(routine)
+            self.schedule(routine)
+            self.persist("add", routine)
+        return routine
+
+    def schedule(self, routine):  # Push the routine in the scheduler queue (the condition must be held)
+        routine.scheduled = True
+        is_first = not self.queue or routine.time < self.queue[0][0]
+        heapq.heappush(self.queue, (routine.time, next(self.sequence), routine))
+        if is_first:
+            self.condition.notify()  # The next deadline changed
+
+    def discard(self, routine):  # Remove the routine from the routines list (the condition must be held)
+        routine.scheduled = False  # The heap entry is dropped lazily when it reaches the top
+        self.routines.remove(routine)
 
     def remove_routine(self, id):  # Remove a routine with the current name/object/pos
-        if isinstance(id, basestring):
-            for routine in self.routines:
-                if routine.name == id:
-                    self.routines.remove(routine)
-                    self.logger.debug("Removed routine: " + id)
+        with self.condition:
+            if isinstance(id, basestring):
+                for routine in self.routines:
+                    if routine.name == id:
+                        self.discard(routine)
+                        self.persist("remove", routine)
+                        self.logger.debug("Removed routine: " + id)
+                        return True
+            elif isinstance(id, Routine):
+                if id in self.routines:
+                    self.discard(id)
+                    self.persist("remove", id)
+                    self.logger.debug("Removed routine: " + id.name)
                     return True
-        elif isinstance(id, Routine):
-            self.routines.remove(id)
-            self.logger.debug("Removed routine: " + id.name)
-            return True
-        else:
-            try:
-                tmp_routine = self.routines.pop(id)
-                self.logger.debug("Removed routine " + tmp_routine.name + " at position: " + str(id))
-                return True
-            except IndexError:
-                self.logger.warning("Could not remove the routine")
+            else:
+                try:
+                    tmp_routine = self.routines[id]
+                    self.discard(tmp_routine)
+                    self.persist("remove", tmp_routine)
+                    self.logger.debug("Removed routine " + tmp_routine.name + " at position: " + str(id))
+                    return True
+                except (IndexError, TypeError):
+                    pass
+        self.logger.warning("Could not remove the routine")
         return False
 
     @staticmethod
     def convert_to_datetime(year, month, day, hour, minutes,  second, microsecond):  # Return the corresponding date
         return datetime.datetime(year, month, day, hour, minutes, second, microsecond)
 
+    @staticmethod
+    def seconds_until(time):  # Return the seconds left before the given datetime
+        delta = time - datetime.datetime.now()
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
     # Attach a telegram routine that sends a telegram message when the time occurs
-    def attach_telegram_alert_routine(self, routine_name, text, chat_id=-1, time=datetime.datetime.now()):
-        script = self.parent.telegram_manager.broadcast_message
+    def attach_telegram_alert_routine(self, routine_name, text, chat_id=-1, time=datetime.datetime.now(), repeat=False):
+        script = "telegram_broadcast"
         args = []
         if chat_id != -1:
-            script = self.parent.telegram_manager.send_message
+            script = "telegram_send"
             args.append(chat_id)
         args.append(text)
-        self.add_routine(routine_name, time, script, args)
+        self.add_routine(routine_name, time, script, args, repeat, target="telegram")
 
     def routines_to_string(self):  # Return a string containing the routines names
         if len(self.routines) == 0:
@@ -78,17 +208,215 @@ class RoutinesManager:
 
 
 class Routine:
-    def __init__(self, name, time, script, script_args=(), repeat=False):
+    MISFIRE_SKIP = "skip"  # Drop the runs missed while the kernel was down or busy
+    MISFIRE_RUN_ONCE = "run_once"  # Run once for all the missed runs
+    MISFIRE_RUN_ALL = "run_all"  # Run once for every missed run
+    misfire_policies = (MISFIRE_SKIP, MISFIRE_RUN_ONCE, MISFIRE_RUN_ALL)
+
+    time_format = "%Y-%m-%d %H:%M:%S.%f"  # Saved run times format
+
+    def __init__(self, name, time, script, script_args=(), repeat=False, misfire_policy=None, target=None,
+                 timeout=None, action=None, id=None):
         self.name = name  # Routine's name
         self.time = time  # Next time the routine will run
         self.script = script  # Routine's script
         self.script_args = script_args  # Script's arguments
         self.repeat = repeat  # If and how much time later it will repeat the routine
+        self.recurrence = Routine.parse_repeat(repeat)  # Computes the next run times, None for one-shot routines
+        if misfire_policy is None:
+            misfire_policy = Routine.MISFIRE_RUN_ONCE
+        if misfire_policy not in Routine.misfire_policies:
+            raise ValueError("Invalid misfire policy: " + str(misfire_policy))
+        self.misfire_policy = misfire_policy  # What to do with the runs missed while the kernel was down or busy
+        self.target = target  # Routines with the same target (e.g. a device) never run concurrently
+        self.timeout = timeout  # Seconds the routine can run before being abandoned, None for the pool default
+        self.action = action  # Name of the registered script, None if the routine can't be saved
+        self.id = id or uuid.uuid4().hex  # Identifier that survives restarts
+        self.scheduled = False  # Is the routine waiting in the scheduler queue?
 
     def run(self):  # Run the routine
         result = self.script(*self.script_args)
         return result
 
+    def next_time(self, after):  # Return the first run time after the given datetime, None if it won't repeat
+        if self.recurrence is None:
+            return None
+        return self.recurrence.next_time(self.time, after)
+
+    def to_record(self):  # Return a json serializable copy of the routine
+        repeat = self.repeat
+        if isinstance(repeat, datetime.timedelta):
+            repeat = Interval.microseconds(repeat) / 1e6
+        return {"op": "add", "id": self.id, "name": self.name, "time": self.time.strftime(Routine.time_format),
+                "action": self.action, "args": list(self.script_args), "repeat": repeat,
+                "misfire_policy": self.misfire_policy, "target": self.target, "timeout": self.timeout}
+
+    @staticmethod
+    def from_record(record, actions):  # Build a routine from its record, the action is looked up in actions
+        time = datetime.datetime.strptime(record["time"], Routine.time_format)
+        return Routine(record["name"], time, actions[record["action"]], record["args"], record["repeat"],
+                       record["misfire_policy"], record["target"], record["timeout"], record["action"], record["id"])
+
+    @staticmethod
+    def parse_repeat(repeat):  # Convert the repeat option (seconds, timedelta or cron expression) to a recurrence
+        if repeat is False or repeat is None:
+            return None
+        if isinstance(repeat, basestring):
+            return CronExpression(repeat)
+        if isinstance(repeat, (int, long, float)) and not isinstance(repeat, bool):
+            repeat = datetime.timedelta(seconds=repeat)
+        if isinstance(repeat, datetime.timedelta):
+            return Interval(repeat)
+        raise ValueError("Invalid repeat option: " + str(repeat))
+
+
+class RoutineJournal:
+    min_compaction_records = 100  # Never compact journals smaller than this
+    compaction_ratio = 2  # Compact when the journal has this many records per live routine
+
+    def __init__(self, database, file_name="routines"):
+        self.logger = logging.getLogger("DomoRoom-routine_journal")  # Default logger
+        self.database = database  # Database manager
+        self.file_name = file_name  # Journal file
+        self.records = 0  # Records currently in the journal
+
+    def load(self):  # Replay the journal, return the records of the live routines
+        if not database_manager.DatabaseManager.file_exist(self.file_name):
+            return []
+        routines = OrderedDict()
+        records = self.database.read_records(self.file_name)
+        for data in records:
+            try:
+                event = json.loads(data)
+                if event["op"] == "add":
+                    routines[event["id"]] = event
+                elif event["op"] == "remove" or (event["op"] == "fired" and event["time"] is None):
+                    routines.pop(event["id"], None)
+                elif event["op"] == "fired" and event["id"] in routines:
+                    routines[event["id"]]["time"] = event["time"]
+            except (ValueError, KeyError, TypeError):
+                self.logger.warning("Skipped an invalid journal record")
+        self.records = len(records)
+        return list(routines.values())
+
+    def append(self, event):  # Append an event on the journal
+        self.database.append_record(self.file_name, json.dumps(event))
+        self.records += 1
+
+    def add(self, routine):  # Save a new routine
+        self.append(routine.to_record())
+
+    def remove(self, routine):  # Save a routine removal
+        self.append({"op": "remove", "id": routine.id})
+
+    def fired(self, routine, next_time):  # Save a routine run, next_time is None if it won't run again
+        if next_time is not None:
+            next_time = next_time.strftime(Routine.time_format)
+        self.append({"op": "fired", "id": routine.id, "time": next_time})
+
+    def needs_compaction(self, routines_number):  # Return true if the journal is mostly made of stale events
+        limit = max(RoutineJournal.min_compaction_records, RoutineJournal.compaction_ratio * routines_number)
+        return self.records > limit
+
+    def compact(self, routines):  # Rewrite the journal with a single record per routine
+        records = [json.dumps(r.to_record()) for r in routines if r.action is not None]
+        self.database.write_records(self.file_name, records)
+        self.records = len(records)
+        self.logger.debug("Compacted routines journal: " + str(len(records)) + " records")
+
+
+class Interval:
+    def __init__(self, interval):
+        self.interval = Interval.microseconds(interval)  # Interval between two runs
+        if self.interval <= 0:
+            raise ValueError("The repeat interval must be positive")
+
+    def next_time(self, start, after):  # Return the first start + k * interval strictly after the given datetime
+        if after < start:
+            return start
+        steps = Interval.microseconds(after - start) // self.interval + 1
+        return start + datetime.timedelta(microseconds=steps * self.interval)
+
+    @staticmethod
+    def microseconds(delta):  # Return the timedelta length in microseconds
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class CronExpression:
+    aliases = {"@yearly": "0 0 1 1 *", "@annually": "0 0 1 1 *", "@monthly": "0 0 1 * *",
+               "@weekly": "0 0 * * 0", "@daily": "0 0 * * *", "@hourly": "0 * * * *"}  # Common expressions
+    bounds = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))  # Minute, hour, day, month, weekday ranges
+    max_years = 5  # How far to look for the next match before giving up
+
+    def __init__(self, expression):
+        self.expression = expression  # Cron expression (minute hour day month weekday)
+        fields = CronExpression.aliases.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression: " + expression)
+        values = [CronExpression.parse_field(f, low, high) for f, (low, high) in zip(fields, CronExpression.bounds)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values  # Sorted allowed values
+        self.weekdays = set(d % 7 for d in weekdays)  # 0 and 7 are both sunday
+        self.any_day = fields[2] == "*"  # Day and weekday match in OR unless one of them is unrestricted
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def parse_field(field, low, high):  # Return the sorted values of a cron field (*, */n, a-b, a-b/n, a,b)
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = [int(v) for v in part.split("-", 1)]
+            else:
+                start = end = int(part)
+                if step != 1:
+                    end = high
+            if not (low <= start <= end <= high) or step < 1:
+                raise ValueError("Invalid cron field: " + field)
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def day_matches(self, day):  # Return true if the given date matches the day and weekday fields
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return in_weekdays
+        if self.any_weekday:
+            return in_days
+        return in_days or in_weekdays
+
+    def next_time(self, start, after):  # Return the first matching minute strictly after the given datetime
+        after = max(after, start - datetime.timedelta(minutes=1))
+        t = (after + datetime.timedelta(minutes=1)).replace(second=0, microsecond=0)
+        limit = t.year + CronExpression.max_years
+        while t.year <= limit:
+            if t.month not in self.months:  # Jump to the next allowed month
+                pos = bisect.bisect_right(self.months, t.month)
+                if pos < len(self.months):
+                    t = t.replace(month=self.months[pos], day=1, hour=0, minute=0)
+                else:
+                    t = t.replace(year=t.year + 1, month=self.months[0], day=1, hour=0, minute=0)
+                continue
+            if not self.day_matches(t):  # Jump to the next day
+                t = (t + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if t.hour not in self.hours:  # Jump to the next allowed hour of the day
+                pos = bisect.bisect_right(self.hours, t.hour)
+                if pos < len(self.hours):
+                    t = t.replace(hour=self.hours[pos], minute=0)
+                else:
+                    t = (t + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            pos = bisect.bisect_left(self.minutes, t.minute)  # Jump to the next allowed minute of the hour
+            if pos < len(self.minutes):
+                return t.replace(minute=self.minutes[pos])
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+        return None
+
 
 if __name__ == "__main__":
     RoutinesManager(None)
@@ -0,0 +1,144 @@
+#
+#   Author: Alessandro Taufer
+#   Email: alexander141220@gmail.com
+#   Url: https://github.com/AlessandroTaufer
+#
+import logging
+import time
+from threading import Thread, Event, Lock, current_thread, active_count
+
+
+class Runtime:  # Starts and stops the kernel subsystems in order, supervises their threads and measures their lag
+    current = None  # Runtime of the running kernel, used by the module functions
+
+    def __init__(self, lag_interval=0.5, max_backoff=60):
+        self.logger = logging.getLogger("DomoRoom-runtime")  # Default logger
+        self.lag_interval = lag_interval  # Seconds between two heartbeats
+        self.max_backoff = max_backoff  # Maximum seconds before restarting a crashed thread
+        self.subsystems = []  # (name, object) in startup order
+        self.threads = {}  # Subsystem: supervised threads
+        self.pools = {}  # Subsystem: worker pools, the executors of the blocking work
+        self.lags = {}  # Subsystem: [samples, total lag, maximum lag]
+        self.lock = Lock()  # Protects the registries
+        self.enabled = True  # Runtime status, crashed threads are restarted only while enabled
+        self.stopped = Event()  # Set when the shutdown is complete
+        Runtime.current = self
+        self.spawn("runtime", self.heartbeat, name="heartbeat", restart=False)
+
+    def start(self, name, factory, *args):  # Build a subsystem, stop the already started ones if it fails
+        self.logger.info("Starting " + name)
+        try:
+            subsystem = factory(*args)
+        except Exception as e:
+            self.logger.error("Could not start " + name + ": " + str(e))
+            self.stop()
+            raise
+        with self.lock:
+            self.subsystems.append((name, subsystem))
+        return subsystem
+
+    def spawn(self, subsystem, target, args=(), name=None, restart=True):  # Start a supervised thread
+        name = name or getattr(target, "__name__", "thread")
+        thread = Thread(target=self.supervise, args=(subsystem, name, target, args, restart), name=name)
+        thread.daemon = True  # A thread stuck in a blocking call doesn't prevent the exit after stop()
+        with self.lock:
+            self.threads.setdefault(subsystem, []).append(thread)
+        thread.start()
+        return thread
+
+    def supervise(self, subsystem, name, target, args, restart):  # Run a thread target, restart it if it crashes
+        backoff = 1
+        while True:
+            try:
+                target(*args)
+                return
+            except Exception as e:
+                self.logger.error("Thread '" + name + "' of " + subsystem + " crashed: " + str(e))
+            if not restart or not self.enabled:
+                return
+            self.logger.info("Restarting '" + name + "' in " + str(backoff) + "s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def register_pool(self, subsystem, pool):  # Show a worker pool in the subsystem report
+        with self.lock:
+            self.pools.setdefault(subsystem, []).append(pool)
+
+    def record_lag(self, subsystem, lag):  # Add how late a scheduled action started
+        with self.lock:
+            lags = self.lags.setdefault(subsystem, [0, 0.0, 0.0])
+            lags[0] += 1
+            lags[1] += lag
+            lags[2] = max(lags[2], lag)
+
+    def heartbeat(self):  # Measure how late a sleeping thread wakes up, the lag of the whole process
+        while self.enabled:
+            start = time.time()
+            time.sleep(self.lag_interval)
+            self.record_lag("runtime", max(0.0, time.time() - start - self.lag_interval))
+
+    def stop(self, timeout=10):  # Stop the subsystems in reverse startup order, wait up to timeout for their threads
+        self.enabled = False
+        with self.lock:
+            subsystems = list(reversed(self.subsystems))
+            self.subsystems = []
+        for name, subsystem in subsystems:
+            self.logger.info("Stopping " + name)
+            try:
+                subsystem.stop()
+            except Exception as e:
+                self.logger.error("Could not stop " + name + ": " + str(e))
+        deadline = time.time() + timeout
+        with self.lock:
+            threads = [t for threads in self.threads.values() for t in threads if t is not current_thread()]
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        alive = [thread.name for thread in threads if thread.is_alive()]
+        if alive:
+            self.logger.warning("Threads still running after the shutdown: " + ", ".join(alive))
+        if Runtime.current is self:
+            Runtime.current = None
+        self.stopped.set()
+
+    def wait(self):  # Block until the runtime is stopped, the supervised threads are daemons
+        while not self.stopped.wait(1):  # A timeout keeps the wait interruptible by Ctrl-C
+            pass
+
+    def report(self):  # Return the threads, loop lag and task latency of every subsystem
+        with self.lock:
+            names = [name for name, subsystem in self.subsystems]
+            names += sorted((set(self.threads) | set(self.pools)) - set(names))
+            lines = []
+            counted = 0  # Threads attributed to a subsystem
+            for name in names:
+                threads = len([t for t in self.threads.get(name, []) if t.is_alive()])
+                pools = self.pools.get(name, [])
+                threads += sum(pool.alive_threads() for pool in pools)
+                counted += threads
+                line = name + ": " + str(threads) + " threads"
+                lags = self.lags.get(name)
+                if lags and lags[0]:
+                    line += ", loop lag avg %.1fms max %.1fms" % (lags[1] / lags[0] * 1000, lags[2] * 1000)
+                lines.append(line)
+                lines += ["  " + pool.metrics_to_string() for pool in pools]
+        total = active_count()  # Main thread, webhook requests and any other unsupervised thread included
+        lines.append("process: " + str(total) + " threads, " + str(max(0, total - counted)) + " outside the subsystems")
+        return "\n".join(lines)
+
+
+def spawn(subsystem, target, args=(), name=None, restart=True):  # Start a thread, supervised if a runtime is running
+    if Runtime.current is not None:
+        return Runtime.current.spawn(subsystem, target, args, name, restart)
+    thread = Thread(target=target, args=args)
+    thread.start()
+    return thread
+
+
+def register_pool(subsystem, pool):  # Show a worker pool in the report of the running runtime
+    if Runtime.current is not None:
+        Runtime.current.register_pool(subsystem, pool)
+
+
+def record_lag(subsystem, lag):  # Add a scheduling lag sample to the running runtime
+    if Runtime.current is not None:
+        Runtime.current.record_lag(subsystem, lag)
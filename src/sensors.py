@@ -0,0 +1,230 @@
+#
+#   Author: Alessandro Taufer
+#   Email: alexander141220@gmail.com
+#   Url: https://github.com/AlessandroTaufer
+#
+import logging
+import bisect
+import heapq
+import itertools
+import os
+import re
+import runtime
+import time
+import worker_pool
+from array import array
+from threading import Condition, Lock
+
+
+class SensorSampler:  # Reads the sensors on schedule and writes the samples in batches
+    def __init__(self, store, buffer_size=4096, batch_size=256, flush_interval=60, workers=4):
+        self.logger = logging.getLogger("DomoRoom-sensor_sampler")  # Default logger
+        self.store = store  # Time series store
+        self.buffer = RingBuffer(buffer_size)  # Samples waiting to be written
+        self.batch_size = batch_size  # Samples that trigger a write
+        self.flush_interval = flush_interval  # Maximum seconds a sample waits in the buffer
+        self.pool = worker_pool.WorkerPool("sensors", size=workers, default_timeout=30,
+                                           subsystem="devices")  # Reads the sensors
+        self.sensors = {}  # Sensor name: sensor
+        self.queue = []  # Min-heap of (sample time, sequence, sensor)
+        self.sequence = itertools.count()  # Heap tie breaker
+        self.condition = Condition()  # Protects the sensors and wakes up the scheduler
+        self.flush_condition = Condition()  # Wakes up the writer
+        self.enabled = True  # Sampler status
+        runtime.spawn("devices", self.behaviour, name="sensor sampler")
+        runtime.spawn("devices", self.writer, name="sensor writer")
+
+    def add_sensor(self, sensor):  # Start sampling a sensor
+        with self.condition:
+            self.sensors[sensor.name] = sensor
+            heapq.heappush(self.queue, (time.time(), next(self.sequence), sensor))
+            self.condition.notify()
+
+    def remove_sensor(self, sensor):  # Stop sampling a sensor
+        with self.condition:
+            if self.sensors.get(sensor.name) is sensor:
+                del self.sensors[sensor.name]  # Its heap entry is dropped when it reaches the top
+
+    def stop(self):  # Stop sampling and write the buffered samples
+        with self.condition:
+            self.enabled = False
+            self.condition.notify()
+        with self.flush_condition:
+            self.flush_condition.notify()
+        self.pool.stop()
+
+    def behaviour(self):  # Hand the due sensor reads to the worker pool
+        while self.enabled:
+            with self.condition:
+                while self.queue and self.sensors.get(self.queue[0][2].name) is not self.queue[0][2]:
+                    heapq.heappop(self.queue)  # Removed sensor
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                delay = self.queue[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                runtime.record_lag("devices", -delay)
+                sample_time, sequence, sensor = heapq.heappop(self.queue)
+                next_time = max(sample_time + sensor.interval, time.time())  # Skip the samples missed while busy
+                heapq.heappush(self.queue, (next_time, next(self.sequence), sensor))
+            self.pool.submit(self.sample, (sensor,), sensor.name, name="sample " + sensor.name)
+
+    def sample(self, sensor):  # Read a sensor and buffer its value
+        value = sensor.get_value()
+        if value is None:
+            return
+        if self.buffer.push(sensor.name, time.time(), float(value)) >= self.batch_size:
+            with self.flush_condition:
+                self.flush_condition.notify()
+
+    def writer(self):  # Write the buffered samples in batches
+        while True:
+            with self.flush_condition:
+                if self.enabled and len(self.buffer) < self.batch_size:
+                    self.flush_condition.wait(self.flush_interval)
+            self.flush()
+            if not self.enabled:
+                break
+
+    def flush(self):  # Write all the buffered samples
+        samples = self.buffer.drain()
+        if not samples:
+            return
+        try:
+            self.store.append(samples)
+        except (IOError, OSError):
+            self.logger.error("Could not write " + str(len(samples)) + " sensor samples")
+        if self.buffer.dropped:
+            self.logger.warning("Sensor buffer full, dropped " + str(self.buffer.dropped) + " samples")
+            self.buffer.dropped = 0
+
+
+class RingBuffer:  # Fixed size sample buffer, the oldest samples are overwritten when full
+    def __init__(self, size):
+        self.size = size  # Maximum samples
+        self.names = [None] * size  # Sensor names
+        self.times = array("d", [0.0]) * size  # Sample times
+        self.values = array("d", [0.0]) * size  # Sample values
+        self.start = 0  # Position of the oldest sample
+        self.count = 0  # Buffered samples
+        self.dropped = 0  # Samples overwritten before being written
+        self.lock = Lock()  # Protects the positions
+
+    def push(self, name, timestamp, value):  # Add a sample, return the buffered samples count
+        with self.lock:
+            pos = (self.start + self.count) % self.size
+            self.names[pos] = name
+            self.times[pos] = timestamp
+            self.values[pos] = value
+            if self.count == self.size:
+                self.start = (self.start + 1) % self.size
+                self.dropped += 1
+            else:
+                self.count += 1
+            return self.count
+
+    def drain(self):  # Remove and return all the samples as (name, time, value) tuples, oldest first
+        with self.lock:
+            samples = []
+            for i in range(self.count):
+                pos = (self.start + i) % self.size
+                samples.append((self.names[pos], self.times[pos], self.values[pos]))
+                self.names[pos] = None
+            self.start = 0
+            self.count = 0
+            return samples
+
+    def __len__(self):
+        return self.count
+
+
+class TimeSeriesStore:  # Columnar sample files, one time and one value column per sensor and day
+    segment_span = 86400  # Seconds covered by a segment
+    item_size = array("d").itemsize  # Bytes of a column item
+
+    def __init__(self, path="../resources/files/sensors/"):
+        self.path = path  # Root folder, one sub folder per sensor
+        self.lock = Lock()  # Serializes the writes
+
+    @staticmethod
+    def sensor_folder(name):  # Return a file system safe folder name for the sensor
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+    def segment_path(self, name, segment):  # Return the column files prefix of a segment
+        return os.path.join(self.path, TimeSeriesStore.sensor_folder(name), str(segment))
+
+    def append(self, samples):  # Append a batch of (name, time, value) samples
+        columns = {}
+        for name, timestamp, value in samples:
+            segment = int(timestamp // TimeSeriesStore.segment_span)
+            times, values = columns.setdefault((name, segment), (array("d"), array("d")))
+            times.append(timestamp)
+            values.append(value)
+        with self.lock:
+            for (name, segment), (times, values) in columns.items():
+                prefix = self.segment_path(name, segment)
+                if not os.path.isdir(os.path.dirname(prefix)):
+                    os.makedirs(os.path.dirname(prefix))
+                TimeSeriesStore.align_columns(prefix)
+                with open(prefix + ".t", "ab") as f:
+                    times.tofile(f)
+                with open(prefix + ".v", "ab") as f:
+                    values.tofile(f)
+
+    @staticmethod
+    def align_columns(prefix):  # Truncate the longer column, left by a crash between the two appends
+        sizes = [os.path.getsize(prefix + extension) if os.path.isfile(prefix + extension) else 0
+                 for extension in (".t", ".v")]
+        size = min(sizes) // TimeSeriesStore.item_size * TimeSeriesStore.item_size
+        for extension, column_size in zip((".t", ".v"), sizes):
+            if column_size > size:
+                with open(prefix + extension, "r+b") as f:
+                    f.truncate(size)
+
+    def segments(self, name, start, end):  # Return the segments overlapping the time range, oldest first
+        folder = os.path.join(self.path, TimeSeriesStore.sensor_folder(name))
+        if not os.path.isdir(folder):
+            return []
+        first = int(start // TimeSeriesStore.segment_span)
+        last = int(end // TimeSeriesStore.segment_span)
+        found = set()
+        for file_name in os.listdir(folder):
+            segment, extension = os.path.splitext(file_name)
+            if extension == ".t" and segment.isdigit() and first <= int(segment) <= last:
+                found.add(int(segment))
+        return sorted(found)
+
+    def load_segment(self, name, segment):  # Return the time and value columns of a segment
+        prefix = self.segment_path(name, segment)
+        items = min(os.path.getsize(prefix + ".t"), os.path.getsize(prefix + ".v")) // TimeSeriesStore.item_size
+        times, values = array("d"), array("d")  # A crash between the two appends leaves one column longer
+        with open(prefix + ".t", "rb") as f:
+            times.fromfile(f, items)
+        with open(prefix + ".v", "rb") as f:
+            values.fromfile(f, items)
+        return times, values
+
+    def query(self, name, start, end):  # Iterate over the (time, value) samples in [start, end), one segment at a time
+        for segment in self.segments(name, start, end):
+            times, values = self.load_segment(name, segment)
+            for i in range(bisect.bisect_left(times, start), bisect.bisect_left(times, end)):
+                yield times[i], values[i]
+
+    def aggregate(self, name, start, end, bucket):  # Return (bucket start, min, max, mean, count) per bucket
+        buckets = []
+        current = None
+        for timestamp, value in self.query(name, start, end):
+            bucket_start = start + (timestamp - start) // bucket * bucket
+            if current is None or current[0] != bucket_start:
+                if current is not None:
+                    buckets.append((current[0], current[1], current[2], current[3] / current[4], current[4]))
+                current = [bucket_start, value, value, 0.0, 0]
+            current[1] = min(current[1], value)
+            current[2] = max(current[2], value)
+            current[3] += value
+            current[4] += 1
+        if current is not None:
+            buckets.append((current[0], current[1], current[2], current[3] / current[4], current[4]))
+        return buckets
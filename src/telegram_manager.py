@@ -3,24 +3,42 @@
 #   Email: alexander141220@gmail.com
 #   Url: https://github.com/AlessandroTaufer
 #
+import hashlib
+import json
 import logging
+import runtime
 import telegram
 import time
-from cv2 import imwrite
-from telegram.error import NetworkError, Unauthorized
-from threading import Thread
+import worker_pool
+from cv2 import imencode, IMWRITE_JPEG_QUALITY, error as CvError
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+from io import BytesIO
+from telegram.error import NetworkError, Unauthorized, RetryAfter, BadRequest, ChatMigrated
+from threading import Lock
 
 
 class TelegramManager:
+    api_url = None  # Bot API base url, None for the Telegram servers (e.g. a local fake endpoint for testing)
+    webhook_port = 8443  # Local port of the webhook server, behind a https reverse proxy
 
     def __init__(self, parent):
         self.parent = parent  # Class parent
-        self.allowed_chats = []  # Chats allowed to use the bot
+        self.allowed_chats = set()  # Chats allowed to use the bot
+        self.gatekeeper = Gatekeeper()  # Filters the messages of the other chats
+        self.chat_names = TTLCache(ttl=3600)  # Chat id: chat description
         self.bot = None  # Telegram bot instance
         self.update_id = None  # Id of the different updates
         self.logger = logging.getLogger("DomoRoom-telegram_manager")  # Default logger
         self.bot_tag = None  # Tag of the current bot
         self.enabled = True  # update listener status
+        self.outbox = Outbox(self)  # Outgoing messages queue
+        self.dispatcher = worker_pool.WorkerPool("telegram_updates", size=4, default_timeout=300,
+                                                 subsystem="telegram")  # Checks and forwards the messages
+        self.webhook_url = None  # Public url of the webhook, None to poll for updates
+        self.server = None  # Webhook server
+        self.receive_lock = Lock()  # Orders the webhook updates
 
         self.load_data()
         self.attach_listener()
@@ -33,32 +51,47 @@ class TelegramManager:
         self.bot_tag = self.parent.database_manager.read_line("telegram", 0)
         chats = self.parent.database_manager.read_line("telegram", 1)
         if chats is not None:
-            chats = chats.split(",")
-            self.allowed_chats = [int(chat) for chat in chats]
+            self.allowed_chats = set(int(chat) for chat in chats.split(",") if chat)
+        store = self.parent.database_manager.record_store("telegram")
+        self.webhook_url = store.read(2) or None
+        self.gatekeeper.banned = set(int(chat) for chat in (store.read(3) or "").split(",") if chat)
         self.logger.debug("Allowed chats " + str(self.allowed_chats))
         pass
 
     def attach_listener(self):  # Initialize and attach a telegram updates listener
-        self.bot = telegram.Bot(self.bot_tag)
+        if self.api_url is not None:
+            self.bot = telegram.Bot(self.bot_tag, base_url=self.api_url)
+        else:
+            self.bot = telegram.Bot(self.bot_tag)
         self.logger.debug(self.bot)
         self.broadcast_message("Bot is now online")
         if self.bot is None:
             self.logger.error("Failed to initialize telegram bot " + str(self.__class__))
             exit(1)
+        if self.webhook_url:
+            self.start_webhook()
+            return
+        self.bot.delete_webhook()  # Telegram refuses get_updates while a webhook is set
         try:
             self.update_id = self.bot.get_updates()[0].update_id + 1
         except IndexError:
             self.update_id = None
             self.logger.warning("Update index error " + str(self.__class__))
-        Thread(target=self.updates_listener, args=()).start()
+        runtime.spawn("telegram", self.updates_listener)
+
+    def start_webhook(self):  # Receive the updates on a local http server instead of polling
+        path = "/" + hashlib.sha256(self.bot_tag).hexdigest()[:32]  # Secret path, only Telegram knows it
+        self.server = WebhookServer(self, ("", self.webhook_port), path)
+        runtime.spawn("telegram", self.server.serve_forever, name="webhook server")
+        self.bot.set_webhook(url=self.webhook_url.rstrip("/") + path, max_connections=1)  # Updates arrive in order
+        self.logger.info("Listening for updates on port " + str(self.webhook_port))
 
     def updates_listener(self):  # Listen from telegram updates
         while self.enabled:
             try:
                 for update in self.bot.get_updates(offset=self.update_id, timeout=10):
                     self.update_id = update.update_id + 1
-                    if update.message:
-                        self.on_message(update)
+                    self.dispatch(update)
 
             except NetworkError:  # An network error has occurred
                 time.sleep(1)
@@ -66,83 +99,343 @@ class TelegramManager:
             except Unauthorized:  # The user has removed or blocked the bot.
                 self.update_id += 1
 
+    def receive(self, data):  # Handle an update pushed to the webhook
+        update = telegram.Update.de_json(data, self.bot)
+        with self.receive_lock:
+            if update is None or (self.update_id is not None and update.update_id < self.update_id):
+                return  # Telegram delivers an update again if it wasn't acknowledged in time
+            self.update_id = update.update_id + 1
+            self.dispatch(update)
+
+    def dispatch(self, update):  # Queue a message, the messages of a chat run in order, different chats in parallel
+        if update.message:
+            if update.message.chat_id not in self.allowed_chats and not self.gatekeeper.allow(update.message.chat_id):
+                return  # Banned or flooding chat: dropped before costing anything
+            self.dispatcher.submit(self.on_message, (update,), update.message.chat_id,
+                                   name="update " + str(update.update_id))
+
     def on_message(self, update, extra_function=None):  # Verify and elaborate the received message
         received_text = update.message.text
         current_chat_id = update.message.chat_id
         self.logger.debug("message chat id " + str(current_chat_id))
         if current_chat_id in self.allowed_chats:
             self.logger.info("Received message:" + received_text)
-            self.parent.control_panel.digest_command(received_text, current_chat_id)
+            self.parent.control_panel.post(received_text, current_chat_id)
         else:
             if received_text == "addme":
-                self.parent.control_panel.digest_command(received_text, current_chat_id)
-            update.message.reply_text("This bot is classified, 'addme' to request the clearance")
-            self.logger.warning("Received unauthorized message from: " + str(self.bot.get_chat(update.message.chat_id)))
+                self.parent.control_panel.post(received_text, current_chat_id)
+            self.send_message(current_chat_id, "This bot is classified, 'addme' to request the clearance")
+            self.chat_names.put(current_chat_id, TelegramManager.chat_description(update.message.chat))
+            self.logger.warning("Received unauthorized message from: " + self.chat_name(current_chat_id))
             self.logger.warning("unauthorized message content: " + str(received_text))
         try:
             extra_function(update.message)
         except TypeError:
             self.logger.debug("extra function is None ")
 
-    def send_message(self, chat_id, text):  # Send a message to the given chat
+    def send_message(self, chat_id, text):  # Queue a message to the given chat, return its Task
+        return self.outbox.send(chat_id, text)
+
+    @staticmethod
+    def encode_image(image, quality=90):  # Return an in memory JPEG of a frame (or the content of an image file)
+        if image is None or getattr(image, "size", 1) == 0:  # The camera returned no frame
+            raise ValueError("Empty image")
+        if isinstance(image, basestring):
+            with open(image, "rb") as f:
+                buffer = BytesIO(f.read())
+        else:
+            ret, encoded = imencode(".jpg", image, [IMWRITE_JPEG_QUALITY, quality])
+            if not ret:
+                raise ValueError("Could not encode the image")
+            buffer = BytesIO(encoded.tostring())
+        buffer.name = "image.jpg"  # Upload file name
+        return buffer
+
+    def upload_image(self, chat_id, photo):  # Send an encoded image or a file_id, return the file_id, None on failure
         try:
-            self.bot.sendMessage(chat_id, text)
+            if not isinstance(photo, basestring):
+                photo.seek(0)  # The buffer may have been read by a failed upload
+            self.outbox.wait_turn(chat_id)
+            message = self.bot.send_photo(chat_id, photo)
+            return message.photo[-1].file_id
         except:
-            self.logger.warning("Failed to send message to the current chat " + str(chat_id))
+            self.logger.warning("Failed to send photo to the current chat " + str(chat_id))
+        return None
 
     def send_image(self, chat_id, image):  # Send an image to the given chat
         try:
-            path = "../tmp/tmp.jpg"
-            if not isinstance(image, basestring):
-                imwrite(path, image)
-            else:
-                path = image
-            image = open(path, "rb")
-            self.bot.send_photo(chat_id, image)
-            return True
-        except:
-            self.logger.warning("Failed to send photo to the current chat " + str(chat_id))
-        return False
+            photo = self.encode_image(image)
+        except (IOError, ValueError, CvError):
+            self.logger.warning("Could not read the image " + str(type(image)))
+            return False
+        return self.upload_image(chat_id, photo) is not None
 
-    def broadcast_message(self, text):  # Broadcast a message to all the allowed chats
-        for chat in self.allowed_chats:
-            self.send_message(chat, text)
-        return True
+    def broadcast_message(self, text):  # Queue a message to all the allowed chats, return their Tasks
+        return [self.send_message(chat, text) for chat in list(self.allowed_chats)]
 
-    def broadcast_image(self, image):  # Broadcast a message to all the allowed chats
-        for chat in self.allowed_chats:
-            self.send_image(chat, image)
+    def broadcast_image(self, image):  # Broadcast an image to all the allowed chats, uploading it only once
+        try:
+            photo = self.encode_image(image)
+        except (IOError, ValueError, CvError):
+            self.logger.warning("Could not read the image " + str(type(image)))
+            return False
+        file_id = None  # Telegram copy of the image, reused after the first upload
+        for chat in list(self.allowed_chats):  # The commands can change the set meanwhile
+            sent = self.upload_image(chat, file_id or photo)
+            if file_id is None:
+                file_id = sent
         return True
 
+    @staticmethod
+    def chat_description(chat):  # Return a readable description of a telegram Chat
+        name = chat.title or chat.username or " ".join(n for n in (chat.first_name, chat.last_name) if n)
+        return str(chat.id) + " (" + (name or chat.type) + ")"
+
+    def chat_name(self, chat_id):  # Return the description of a chat, asking Telegram at most once per ttl
+        name = self.chat_names.get(chat_id)
+        if name is None:
+            try:
+                name = TelegramManager.chat_description(self.bot.get_chat(chat_id))
+            except Exception:
+                return str(chat_id)  # Not cached, the next call tries again
+            self.chat_names.put(chat_id, name)
+        return name
+
+    def chats_to_string(self):  # Return the allowed chats with their positions
+        return "\n".join(str(pos) + ": " + self.chat_name(chat) for pos, chat in enumerate(sorted(self.allowed_chats)))
+
     def add_allowed_chat(self, chat_id):  # Add a chat to the telegram allowed chats list
         self.logger.info("Adding chat: " + str(chat_id))
-        self.allowed_chats.append(chat_id)
+        self.allowed_chats.add(chat_id)
+        self.gatekeeper.unban(chat_id)
         self.send_message(chat_id, "You have been added to the allowed chats")
         self.logger.debug("Current allowed chats: " + str(self.allowed_chats))
 
     def remove_allowed_chat(self, pos):  # Remove a chat from the telegram allowed chats list
         try:
             pos = int(pos)
-            if 0 <= pos < len(self.allowed_chats):
-                tmp_chat = self.allowed_chats.pop(pos)
+            if 0 <= pos < len(self.allowed_chats):  # Position in the chats_to_string list
+                tmp_chat = sorted(self.allowed_chats)[pos]
+                self.allowed_chats.remove(tmp_chat)
                 self.logger.info("Removed chat: " + str(tmp_chat))
                 return True
-            elif len(str(pos)) == 8:
+            elif pos in self.allowed_chats:
                 self.allowed_chats.remove(pos)
                 return True
         except (ValueError, IndexError, TypeError):
             logging.warning("Failed to remove chat: invalid parameter " + str(pos))
         return False
 
+    def ban_chat(self, chat_id):  # Drop every message of a chat
+        chat_id = int(chat_id)
+        self.allowed_chats.discard(chat_id)
+        self.gatekeeper.ban(chat_id)
+        self.logger.info("Banned chat: " + str(chat_id))
+
+    def unban_chat(self, chat_id):  # Accept again the messages of a banned chat
+        return self.gatekeeper.unban(int(chat_id))
+
+    def stop(self, timeout=10):  # Stop listening, run the queued commands and deliver the queued messages
+        self.enabled = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.dispatcher.stop(timeout)
+        self.outbox.stop(timeout)
+
     def save_data(self):  # Save the data on file  # TODO save telegram data by pickle
-        chats = ""
-        for c in self.allowed_chats:
-            chats += str(c) + ","
-        chats = chats[:-1]
+        chats = ",".join(str(c) for c in sorted(self.allowed_chats))
         self.parent.database_manager.write_line("telegram", chats, 1)
+        self.parent.database_manager.write_line("telegram", ",".join(str(c) for c in sorted(self.gatekeeper.banned)), 3)
         self.logger.info("Saving telegram data")
 
 
+class Gatekeeper:  # Rate limits the chats not allowed to use the bot and bans the flooding ones
+    def __init__(self, rate=3, period=60, max_strikes=20, max_senders=1024):
+        self.logger = logging.getLogger("DomoRoom-telegram_gatekeeper")  # Default logger
+        self.rate = rate  # Messages of a sender handled per period
+        self.period = period  # Seconds of a rate limit window
+        self.max_strikes = max_strikes  # Messages over the limit that ban the sender
+        self.max_senders = max_senders  # Tracked senders, the least recent are forgotten
+        self.banned = set()  # Chats whose messages are always dropped
+        self.senders = OrderedDict()  # Chat id: [window start, messages in the window, strikes], least recent first
+        self.lock = Lock()  # Protects the senders
+
+    def allow(self, chat_id):  # Return true if a message of a not allowed chat should be handled
+        if chat_id in self.banned:
+            return False
+        now = time.time()
+        with self.lock:
+            sender = self.senders.pop(chat_id, None)
+            if sender is None or now - sender[0] >= self.period:
+                sender = [now, 0, sender[2] if sender is not None else 0]
+            self.senders[chat_id] = sender  # Most recent last
+            if len(self.senders) > self.max_senders:
+                self.senders.popitem(last=False)
+            sender[1] += 1
+            if sender[1] <= self.rate:
+                return True
+            sender[2] += 1
+            if sender[2] >= self.max_strikes:
+                self.banned.add(chat_id)
+                del self.senders[chat_id]
+                self.logger.warning("Banned flooding chat " + str(chat_id))
+            return False
+
+    def ban(self, chat_id):  # Drop every message of a chat
+        self.banned.add(chat_id)
+        with self.lock:
+            self.senders.pop(chat_id, None)
+
+    def unban(self, chat_id):  # Accept again the messages of a chat, return true if it was banned
+        if chat_id not in self.banned:
+            return False
+        self.banned.discard(chat_id)
+        return True
+
+
+class TTLCache:  # Bounded cache whose entries expire after ttl seconds
+    def __init__(self, ttl, max_size=256):
+        self.ttl = ttl  # Seconds an entry is valid
+        self.max_size = max_size  # Maximum entries, the least recently stored are dropped
+        self.entries = OrderedDict()  # Key: (expiry time, value), least recently stored first
+        self.lock = Lock()  # Protects the entries
+
+    def get(self, key):  # Return the cached value, None if missing or expired
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key, value):  # Store a value
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):  # Receives the updates Telegram pushes to the webhook
+    daemon_threads = True  # A stuck connection doesn't keep the program alive
+
+    def __init__(self, manager, address, path):
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.manager = manager  # Telegram manager
+        self.path = path  # Secret webhook path
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # Acknowledge the update at once, the command runs on the dispatcher
+        if self.path != self.server.path:
+            self.send_error(404)
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_error(400)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.server.manager.receive(data)
+
+    def log_message(self, format, *args):  # Send the access log to the logger instead of stderr
+        self.server.manager.logger.debug("Webhook " + self.address_string() + " " + format % args)
+
+
+class Outbox:  # Delivers the outgoing messages on a worker pool, within the Telegram rate limits
+    def __init__(self, manager, workers=3, chat_interval=1.0, global_rate=30, max_retries=5, merge_limit=4096):
+        self.manager = manager  # Telegram manager
+        self.logger = logging.getLogger("DomoRoom-telegram_outbox")  # Default logger
+        self.chat_interval = chat_interval  # Minimum seconds between two messages to the same chat
+        self.global_interval = 1.0 / global_rate  # Minimum seconds between two messages to any chat
+        self.max_retries = max_retries  # Retries of a message after a network error
+        self.merge_limit = merge_limit  # Maximum length of a merged message
+        self.pool = worker_pool.WorkerPool("telegram", size=workers,
+                                           subsystem="telegram")  # One message in flight per chat
+        self.lock = Lock()  # Protects the fields below
+        self.pending = {}  # Chat id: queued message not yet started, the next messages are merged in it
+        self.last_sent = {}  # Chat id: time reserved for the last message
+        self.next_global = 0  # Earliest time of the next message to any chat
+        self.tasks = set()  # Unfinished deliveries
+
+    def send(self, chat_id, text):  # Queue a message, return the Task of the delivery that will contain it
+        with self.lock:
+            message = self.pending.get(chat_id)
+            if message is not None and len(message.text) + len(text) < self.merge_limit:
+                message.text += "\n" + text  # Burst to the same chat: a single message
+                return message.task
+            message = OutgoingMessage(chat_id, text)
+            self.pending[chat_id] = message
+            message.task = self.pool.submit(self.deliver, (message,), chat_id, name="message to " + str(chat_id))
+            self.tasks.add(message.task)
+            return message.task
+
+    def wait_turn(self, chat_id):  # Wait until a message can be sent to the chat without exceeding the limits
+        with self.lock:
+            now = time.time()
+            start = max(now, self.last_sent.get(chat_id, 0) + self.chat_interval)
+            self.last_sent[chat_id] = start
+        if start > now:
+            time.sleep(start - now)
+        with self.lock:  # The global slot is taken only when the chat is ready, a waiting chat doesn't hold it
+            now = time.time()
+            start = max(now, self.next_global)
+            self.next_global = start + self.global_interval
+        if start > now:
+            time.sleep(start - now)
+
+    def deliver(self, message):  # Send a message, retrying on network errors, return true if sent
+        with self.lock:
+            if self.pending.get(message.chat_id) is message:
+                del self.pending[message.chat_id]  # No more merges, the text is final
+        try:
+            for attempt in range(self.max_retries + 1):
+                self.wait_turn(message.chat_id)
+                try:
+                    self.manager.bot.sendMessage(message.chat_id, message.text)
+                    return True
+                except RetryAfter as e:  # Flood limit hit anyway, Telegram tells how long to wait
+                    delay = e.retry_after
+                except (BadRequest, ChatMigrated) as e:  # Retrying the same request would fail again
+                    self.logger.warning("Message to chat " + str(message.chat_id) + " rejected: " + str(e))
+                    return False
+                except NetworkError:  # Timeouts and connection errors, BadRequest is a subclass too
+                    delay = 2 ** attempt
+                except Unauthorized:  # The user has removed or blocked the bot
+                    break
+                except Exception as e:
+                    self.logger.warning("Failed to send message to chat " + str(message.chat_id) + ": " + str(e))
+                    return False
+                if attempt < self.max_retries:
+                    self.logger.info("Retrying message to chat " + str(message.chat_id) + " in " + str(delay) + "s")
+                    time.sleep(delay)
+            self.logger.warning("Failed to send message to the current chat " + str(message.chat_id))
+            return False
+        finally:
+            with self.lock:
+                self.tasks.discard(message.task)
+
+    def stop(self, timeout=10):  # Wait up to timeout seconds for the queued messages, then stop the workers
+        deadline = time.time() + timeout
+        with self.lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.wait(max(0, deadline - time.time()))
+        self.pool.stop(max(0, deadline - time.time()))
+
+
+class OutgoingMessage:
+    def __init__(self, chat_id, text):
+        self.chat_id = chat_id  # Destination chat
+        self.text = text  # Message text, later messages of a burst are appended
+        self.task = None  # Delivery task
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     t = TelegramManager(None)
@@ -0,0 +1,214 @@
+#
+#   Author: Alessandro Taufer
+#   Email: alexander141220@gmail.com
+#   Url: https://github.com/AlessandroTaufer
+#
+import logging
+import time
+import Queue
+import runtime
+from collections import deque
+from threading import Thread, Condition, Event, current_thread
+
+
+class WorkerPool:
+    def __init__(self, name, size=4, max_pending=0, default_timeout=None, subsystem=None):
+        self.name = name  # Pool name, used in the logs
+        self.logger = logging.getLogger("DomoRoom-worker_pool-" + name)  # Default logger
+        self.size = size  # Number of worker threads
+        self.default_timeout = default_timeout  # Seconds a task can run before being abandoned, None to wait forever
+        self.default_key_limit = 1  # Maximum tasks in flight with the same key
+        self.key_limits = {}  # Per key maximum tasks in flight
+        self.tasks = Queue.Queue(max_pending)  # Tasks ready to run, 0 for an unbounded queue
+        self.condition = Condition()  # Protects the counters below and wakes up the watchdog
+        self.in_flight = {}  # Running tasks count for every key
+        self.parked = {}  # Tasks waiting for a free slot of their key
+        self.running = set()  # Running tasks with a deadline
+        self.workers = []  # Worker threads
+        self.metrics = {"submitted": 0, "completed": 0, "failed": 0, "timed_out": 0, "rejected": 0,
+                        "wait_time": 0.0, "run_time": 0.0, "max_wait_time": 0.0, "max_run_time": 0.0}
+        self.enabled = True  # Pool status
+        for i in range(size):
+            self.start_worker()
+        self.watchdog_thread = Thread(target=self.watchdog, args=())  # Expires the tasks past their deadline
+        self.watchdog_thread.daemon = True
+        self.watchdog_thread.start()
+        runtime.register_pool(subsystem or name, self)
+
+    def start_worker(self):  # Start a new worker thread
+        worker = Thread(target=self.work, args=())
+        worker.daemon = True
+        self.workers.append(worker)
+        worker.start()
+
+    def alive_threads(self):  # Return the number of running pool threads, watchdog included
+        threads = list(self.workers) + [self.watchdog_thread]
+        return len([thread for thread in threads if thread.is_alive()])
+
+    def set_key_limit(self, key, limit):  # Set the maximum tasks in flight with the given key
+        with self.condition:
+            self.key_limits[key] = limit
+
+    def submit(self, function, args=(), key=None, timeout=None, name=None):  # Schedule a function call, returns a Task
+        if timeout is None:
+            timeout = self.default_timeout
+        task = Task(name or getattr(function, "__name__", "task"), function, args, key, timeout)
+        with self.condition:
+            self.metrics["submitted"] += 1
+            if key is not None:
+                if self.in_flight.get(key, 0) >= self.key_limits.get(key, self.default_key_limit):
+                    self.parked.setdefault(key, deque()).append(task)  # Runs when a task with the same key ends
+                    return task
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1
+            self.enqueue(task)
+        return task
+
+    def enqueue(self, task):  # Push a task in the ready queue (the condition must be held)
+        try:
+            self.tasks.put(task, False)
+        except Queue.Full:
+            self.metrics["rejected"] += 1
+            self.logger.warning("Rejected task '" + task.name + "': queue is full")
+            task.error = Queue.Full("Worker pool '" + self.name + "' queue is full")
+            self.release(task)
+            task.done.set()
+
+    def release(self, task):  # Free the task key slot, start the next parked task (the condition must be held)
+        if task.key is None:
+            return
+        waiting = self.parked.get(task.key)
+        if waiting:
+            self.enqueue(waiting.popleft())  # The slot is passed on to the parked task
+            if not waiting:
+                del self.parked[task.key]
+            return
+        self.in_flight[task.key] -= 1
+        if self.in_flight[task.key] <= 0:
+            del self.in_flight[task.key]
+
+    def work(self):  # Worker thread main loop
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            self.execute(task)
+            if task.timed_out:
+                break  # A new worker has already replaced this one
+
+    def execute(self, task):  # Run a task and update the metrics
+        task.started = time.time()
+        task.worker = current_thread()
+        if task.timeout is not None:
+            with self.condition:
+                task.deadline = task.started + task.timeout
+                self.running.add(task)
+                self.condition.notify()
+        try:
+            task.result = task.function(*task.args)
+        except Exception as e:
+            task.error = e
+            self.logger.error("Task '" + task.name + "' failed: " + str(e))
+        task.finished = time.time()
+        with self.condition:
+            if task.timed_out:
+                self.logger.info("Task '" + task.name + "' ended after its timeout")
+                return
+            self.running.discard(task)
+            self.record(task)
+            self.release(task)
+        task.done.set()
+
+    def record(self, task):  # Add the task times to the metrics (the condition must be held)
+        wait_time = task.started - task.submitted
+        run_time = task.finished - task.started
+        if not task.timed_out:
+            self.metrics["failed" if task.error is not None else "completed"] += 1
+        self.metrics["wait_time"] += wait_time
+        self.metrics["run_time"] += run_time
+        self.metrics["max_wait_time"] = max(self.metrics["max_wait_time"], wait_time)
+        self.metrics["max_run_time"] = max(self.metrics["max_run_time"], run_time)
+
+    def watchdog(self):  # Abandon the tasks that exceed their timeout
+        with self.condition:
+            while self.enabled:
+                now = time.time()
+                next_deadline = None
+                for task in list(self.running):
+                    if task.deadline <= now:
+                        self.expire(task)
+                    elif next_deadline is None or task.deadline < next_deadline:
+                        next_deadline = task.deadline
+                self.condition.wait(None if next_deadline is None else next_deadline - now)
+
+    def expire(self, task):  # Mark a task as timed out and replace its worker (the condition must be held)
+        self.logger.warning("Task '" + task.name + "' timed out after " + str(task.timeout) + " seconds")
+        self.running.discard(task)
+        task.timed_out = True
+        task.finished = time.time()
+        task.error = TaskTimeout("Task '" + task.name + "' timed out")
+        self.metrics["timed_out"] += 1
+        self.record(task)
+        self.release(task)
+        if task.worker in self.workers:
+            self.workers.remove(task.worker)  # The stuck worker leaves the pool when the call returns
+        self.start_worker()
+        task.done.set()
+
+    def get_metrics(self):  # Return a copy of the metrics, with the average wait and run times
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics["pending"] = self.tasks.qsize() + sum(len(d) for d in self.parked.values())
+        ended = metrics["completed"] + metrics["failed"] + metrics["timed_out"]
+        metrics["avg_wait_time"] = metrics["wait_time"] / ended if ended else 0.0
+        metrics["avg_run_time"] = metrics["run_time"] / ended if ended else 0.0
+        return metrics
+
+    def metrics_to_string(self):  # Return a string with the pool metrics
+        metrics = self.get_metrics()
+        return (self.name + ": " + str(metrics["completed"]) + " completed, " + str(metrics["failed"]) + " failed, " +
+                str(metrics["timed_out"]) + " timed out, " + str(metrics["pending"]) + " pending, " +
+                "avg wait %.3fs, avg run %.3fs" % (metrics["avg_wait_time"], metrics["avg_run_time"]))
+
+    def stop(self, timeout=None):  # Stop the workers once the queued tasks are done
+        with self.condition:
+            self.enabled = False
+            self.condition.notify()
+            workers = list(self.workers)
+        for worker in workers:
+            self.tasks.put(None)
+        for worker in workers:
+            if worker is not current_thread():
+                worker.join(timeout)
+
+
+class Task:
+    def __init__(self, name, function, args=(), key=None, timeout=None):
+        self.name = name  # Task name, used in the logs
+        self.function = function  # Function to run
+        self.args = args  # Function arguments
+        self.key = key  # Tasks with the same key share a concurrency limit (e.g. a device)
+        self.timeout = timeout  # Seconds the task can run before being abandoned
+        self.submitted = time.time()  # When the task entered the pool
+        self.started = None  # When a worker started the task
+        self.finished = None  # When the task ended
+        self.deadline = None  # When the task will be abandoned
+        self.worker = None  # Thread running the task
+        self.timed_out = False  # Has the task exceeded its timeout?
+        self.result = None  # Function return value
+        self.error = None  # Exception raised by the function
+        self.done = Event()  # Set when the task ends
+
+    def wait(self, timeout=None):  # Wait for the task to end, return true if it ended
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def get(self, timeout=None):  # Wait for the task and return its result, raise its error
+        if not self.wait(timeout):
+            raise TaskTimeout("Task '" + self.name + "' is still running")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class TaskTimeout(Exception):
+    pass